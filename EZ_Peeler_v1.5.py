@@ -23,35 +23,100 @@
 
 #import libraries required for plugin
 
-from ij import IJ, ImagePlus, ImageStack, CompositeImage
-from java.awt import Color
-from ij.gui import Roi, PolygonRoi, NonBlockingGenericDialog, Overlay, ImageRoi
-from ij.process import ImageProcessor, StackStatistics, ImageConverter, FloatProcessor,ColorProcessor, ByteProcessor
-from ij.plugin import Slicer, ImageCalculator, Duplicator, ZProjector
-from ij.plugin.filter import GaussianBlur, RankFilters, ThresholdToSelection
+from ij import IJ, ImagePlus, ImageStack, CompositeImage, Prefs, Macro, VirtualStack
+from ij.io import FileSaver, DirectoryChooser, Opener
+from ij.measure import Measurements
+from java.awt import Color, GraphicsEnvironment
+from ij.gui import Roi, PolygonRoi, NonBlockingGenericDialog, Overlay, ImageRoi, DialogListener, ShapeRoi
+from ij.process import ImageProcessor, StackStatistics, ImageConverter, FloatProcessor,ColorProcessor, ByteProcessor, Blitter, ImageStatistics, AutoThresholder
+from ij.plugin import Slicer, ImageCalculator, Duplicator, ZProjector, Filters3D, GaussianBlur3D, Binner
+from ij.plugin.filter import GaussianBlur, RankFilters, ThresholdToSelection, Convolver
 from array import array, zeros
 from collections import OrderedDict
 from script.imglib.math import Compute, Subtract, Divide, Multiply
 from script.imglib import ImgLib  
-from java.lang import Thread
+from net.imglib2.algorithm.morphology.distance import DistanceTransform
+from net.imglib2.img.planar import PlanarImgs
+from java.lang import Thread, Math, Float, Runtime, System, Exception as JavaException
+from java.util.concurrent import Executors, Callable, CountDownLatch, TimeUnit
+from java.awt.event import WindowAdapter
+from java.util.concurrent.locks import ReentrantLock
+import math
+import json
+import threading
+import bisect
+import os
 
 from fiji.util.gui import GenericDialogPlus
 
 try: 
 	from net.haesleinhuepf.clij2 import CLIJ2
 	from net.haesleinhuepf.clij import CLIJ
+	from net.haesleinhuepf.clij.coremem.enums import NativeTypeEnum
+	clijInstalled = True
 except:
-	errorDialog("""EZ-Peeler requires clij to function. 
-	
-	To install please follow these instructions: 
-	
-	1. Click Help>Update> Manage update sites
-	2. Make sure the "clij" and "clij2" update sites are selected.
-	3. Click Close> Apply changes.
-	4. Close and reopen ImageJ""")
-clij2 = CLIJ2.getInstance()
-clij = CLIJ.getInstance()
-clij2.clear()
+	clijInstalled = False
+
+try:
+	from loci.plugins import BF
+	from loci.formats import ImageReader
+	bioformatsInstalled = True
+except:
+	bioformatsInstalled = False
+
+#set to True (or pass check_backends=true) to compare every CPU backend operation against the GPU at startup
+checkBackends = False
+
+#batch runs set this to 1, so that the stages open no windows
+headless = 0
+
+#number of time series frames segmented on CPU threads while the next frames are filtered on the GPU
+framesInFlight = 3
+
+#binning of the coarse surface search (1 searches every voxel), and how many slices below the coarse surface each column is searched
+pyramidFactor = 1
+pyramidBand = 4
+
+#time series: set to True (or pass temporal=true) to search each column only within this many slices of the surface of the previous frame, in strips of this many rows
+temporalSearch = False
+temporalBand = 8
+temporalStrip = 8
+
+#set to True (or pass profile=[file.json or file.csv] to a batch run) to record the time and memory of every stage and CLIJ2 call
+profiling = False
+profileOutput = os.path.join(IJ.getDirectory("temp") or ".", "EZ Peeler profile.json")
+profiler = None
+
+#synthetic stacks timed by the benchmark mode, as (width, height, slices), each at every bit depth and channel count listed
+benchmarkSizes = [(256, 256, 32), (512, 512, 64), (1024, 1024, 96)]
+benchmarkBitDepths = [8, 16]
+benchmarkChannels = [1, 2]
+benchmarkRepeats = 3
+benchmarkSeed = 42
+
+#frames of a virtual stack read from disk ahead of the frame being filtered
+framesPrefetched = 1
+
+#CLIJ2 is not thread safe, so every call into it from the frame pipeline holds this lock
+gpuLock = ReentrantLock()
+
+#threshold index of the last resliced stack, reused while only the threshold changes
+cachedIndex = None
+
+#share of the GPU memory a stage may use, larger stacks are processed in XY tiles
+gpuMemoryFraction = 0.75
+
+#share of the GPU memory (or of the java heap on the CPU backend) that released buffers may hold for reuse
+bufferPoolFraction = 0.25
+
+#share of the java heap that filtered stacks may hold, so going back to the first dialog with the same settings does not filter again
+stageCacheFraction = 0.25
+
+#ImageJ auto threshold method (dark background) that gives the default surface threshold
+autoThresholdMethod = "Otsu"
+
+#milliseconds a dialog slider must rest before its preview is redrawn
+previewDelay = 100
 
 """**********************************define functions*******************************************"""
 def errorDialog(message):
@@ -61,102 +126,542 @@ def errorDialog(message):
 	gd.showDialog()
 	return
 
-
-def areamap(imp1, xscale, yscale):
+class SliceTask(Callable):
+	"""wraps a function of one slice index so it can be handed to a java thread pool"""
+	def __init__(self, function, index):
+		self.function = function
+		self.index = index
+	def call(self):
+		return self.function(self.index)
+
+def parallelSlices(nSlices, function):
+	"""runs function(slice) for slices 1 to nSlices across all of ImageJ's threads"""
+	pool = Executors.newFixedThreadPool(Prefs.getThreads())
+	try:
+		futures = pool.invokeAll([SliceTask(function, i) for i in xrange(1, nSlices+1)])
+		#get() passes on any exception raised in a slice
+		for future in futures:
+			future.get()
+	finally:
+		pool.shutdown()
+
+class DialogClosed(WindowAdapter):
+	"""releases a latch when a non-modal dialog is closed by OK or cancel"""
+	def __init__(self):
+		self.latch = CountDownLatch(1)
+	def windowClosed(self, event):
+		self.latch.countDown()
+	def waitForClose(self, gd):
+		#macro runs never show the dialog, so also stop as soon as it reports OK or cancel
+		while not (gd.wasOKed() or gd.wasCanceled()):
+			self.latch.await(1, TimeUnit.SECONDS)
+
+class PreviewWorker:
+	"""redraws a dialog preview on a background thread once the sliders have rested for previewDelay ms.
+	A new request cancels the pending one, and preview(current) can call current() to drop a result that is already stale"""
+	def __init__(self, preview):
+		self.preview = preview
+		self.executor = Executors.newSingleThreadScheduledExecutor()
+		self.generation = 0
+		self.pending = None
+	def request(self):
+		self.generation += 1
+		if self.pending is not None:
+			self.pending.cancel(False)
+		self.pending = self.executor.schedule(SliceTask(self.run, self.generation), previewDelay, TimeUnit.MILLISECONDS)
+	def run(self, generation):
+		if self.isCurrent(generation):
+			try:
+				self.preview(lambda: self.isCurrent(generation))
+			except Exception, e:
+				print "preview failed: "+str(e)
+	def isCurrent(self, generation):
+		return generation == self.generation
+	def shutdown(self):
+		self.executor.shutdownNow()
+
+class PreviewListener(DialogListener):
+	"""forwards every dialog change to a PreviewWorker instead of redrawing on the UI thread"""
+	def __init__(self, worker):
+		self.worker = worker
+	def dialogItemChanged(self, gd, event):
+		self.worker.request()
+		return True
+
+def previewDialog(gd, preview):
+	"""shows a non-modal dialog, draws preview(current) whenever a control changes and returns once it is closed"""
+	worker = PreviewWorker(preview)
+	closed = DialogClosed()
+	gd.addDialogListener(PreviewListener(worker))
+	gd.addWindowListener(closed)
+	gd.setModal(False)
+	gd.showDialog()
+	worker.request()
+	try:
+		closed.waitForClose(gd)
+	finally:
+		worker.shutdown()
+
+class CPUBuffer:
+	"""host memory stand-in for a CLIJ2 buffer, holding an imagePlus"""
+	def __init__(self, imp):
+		self.imp = imp
+	def getWidth(self):
+		return self.imp.getWidth()
+	def getHeight(self):
+		return self.imp.getHeight()
+	def getDepth(self):
+		return self.imp.getStackSize()
+	def getDimension(self):
+		if self.getDepth() == 1:
+			return 2
+		return 3
+	def getDimensions(self):
+		return [self.getWidth(), self.getHeight(), self.getDepth()]
+	def getNativeType(self):
+		return self.imp.getBitDepth()
+	def getStack(self):
+		return self.imp.getStack()
+	def getSizeInBytes(self):
+		return self.getWidth()*self.getHeight()*self.getDepth()*self.getNativeType()/8
+	def close(self):
+		self.imp.flush()
+
+class CPUBackend:
+	"""multi-threaded CPU versions of the CLIJ2 operations EZ Peeler uses, with the same names and arguments.
+	Median and minimum filters use ImageJ's circular/ellipsoid kernels in place of CLIJ2's boxes and spheres"""
+
+	def getInstance(self, name=None):
+		return self
+	def getAvailableDeviceNames(self):
+		return ["CPU"]
+	def getGPUName(self):
+		return "CPU"
+	def clear(self):
+		return
+	def reportMemory(self):
+		return "CPU backend, " + IJ.freeMemory()
+
+	def push(self, imp):
+		return CPUBuffer(ImagePlus("CPU buffer", imp.getStack().duplicate()))
+	def pull(self, buffer):
+		return ImagePlus("CPU buffer", buffer.getStack().duplicate())
+	def create(self, template, nativeType=None):
+		if isinstance(template, CPUBuffer):
+			dims = template.getDimensions()
+			nativeType = template.getNativeType()
+		else:
+			dims = list(template) + [1]*(3-len(template))
+		return CPUBuffer(ImagePlus("CPU buffer", ImageStack.create(int(dims[0]), int(dims[1]), int(dims[2]), nativeType)))
+
+	def _store(self, dst, index, ip):
+		"""writes a processor into a slice of dst, converting it to the type of dst"""
+		bitDepth = dst.getNativeType()
+		if bitDepth == 8:
+			ip = ip.convertToByte(False)
+		elif bitDepth == 16:
+			ip = ip.convertToShort(False)
+		elif bitDepth == 32:
+			ip = ip.convertToFloat()
+		dst.getStack().setPixels(ip.getPixels(), index)
+
+	def _copy(self, src, dst):
+		for i in xrange(1, src.getDepth()+1):
+			self._store(dst, i, src.getStack().getProcessor(i).duplicate())
+
+	def copy(self, src, dst):
+		self._copy(src, dst)
+	def blur2D(self, src, dst, sigmaX, sigmaY):
+		def blurSlice(i):
+			ip = src.getStack().getProcessor(i).duplicate()
+			GaussianBlur().blurGaussian(ip, sigmaX, sigmaY, 0.002)
+			self._store(dst, i, ip)
+		parallelSlices(src.getDepth(), blurSlice)
+	def blur3D(self, src, dst, sigmaX, sigmaY, sigmaZ):
+		self._copy(src, dst)
+		GaussianBlur3D.blur(dst.imp, sigmaX, sigmaY, sigmaZ)
+	def median2DBox(self, src, dst, radiusX, radiusY):
+		def medianSlice(i):
+			ip = src.getStack().getProcessor(i).duplicate()
+			RankFilters().rank(ip, max(radiusX, radiusY), RankFilters.MEDIAN)
+			self._store(dst, i, ip)
+		parallelSlices(src.getDepth(), medianSlice)
+	def median3DBox(self, src, dst, radiusX, radiusY, radiusZ):
+		dst.imp.setStack(Filters3D.filter(src.getStack(), Filters3D.MEDIAN, radiusX, radiusY, radiusZ))
+	def minimum3DSphere(self, src, dst, radiusX, radiusY, radiusZ):
+		dst.imp.setStack(Filters3D.filter(src.getStack(), Filters3D.MIN, radiusX, radiusY, radiusZ))
+	def resliceTop(self, src, dst):
+		slicer = Slicer()
+		slicer.setNointerpolate(True)
+		dst.imp.setStack(slicer.reslice(ImagePlus("CPU buffer", src.getStack())).getStack())
+
+	def _scalarOp(self, src, dst, operation):
+		def scalarSlice(i):
+			source = src.getStack().getProcessor(i)
+			ip = source.convertToFloat()
+			if ip is source:
+				ip = source.duplicate()
+			operation(ip)
+			self._store(dst, i, ip)
+		parallelSlices(src.getDepth(), scalarSlice)
+	def power(self, src, dst, exponent):
+		self._scalarOp(src, dst, lambda ip: powerFloat(ip, exponent))
+	def addImageAndScalar(self, src, dst, scalar):
+		self._scalarOp(src, dst, lambda ip: ip.add(scalar))
+	def multiplyImageAndScalar(self, src, dst, scalar):
+		self._scalarOp(src, dst, lambda ip: ip.multiply(scalar))
+
+	def _imageOp(self, src1, src2, dst, mode):
+		def imageSlice(i):
+			source = src1.getStack().getProcessor(i)
+			ip = source.convertToFloat()
+			if ip is source:
+				ip = source.duplicate()
+			ip.copyBits(src2.getStack().getProcessor(i).convertToFloat(), 0, 0, mode)
+			self._store(dst, i, ip)
+		parallelSlices(src1.getDepth(), imageSlice)
+	def addImages(self, src1, src2, dst):
+		self._imageOp(src1, src2, dst, Blitter.ADD)
+	def multiplyImages(self, src1, src2, dst):
+		self._imageOp(src1, src2, dst, Blitter.MULTIPLY)
+	def subtract(self, src1, src2, dst):
+		self._imageOp(src1, src2, dst, Blitter.SUBTRACT)
+
+	def copySlice(self, src, dst, z):
+		self._store(dst, int(z)+1, src.getStack().getProcessor(1).duplicate())
+	def convolve(self, src, kernel, dst):
+		weights = kernel.getStack().getProcessor(1).getPixels()
+		def convolveSlice(i):
+			source = src.getStack().getProcessor(i)
+			ip = source.convertToFloat()
+			if ip is source:
+				ip = source.duplicate()
+			convolver = Convolver()
+			convolver.setNormalize(False)
+			convolver.convolve(ip, weights, kernel.getWidth(), kernel.getHeight())
+			self._store(dst, i, ip)
+		parallelSlices(src.getDepth(), convolveSlice)
+
+def powerFloat(ip, exponent):
+	"""raises every pixel of a float processor to a power, like clij2.power (ImageJ's pow zeroes negative values, so squares use sqr)"""
+	if exponent == 2:
+		ip.sqr()
+	elif exponent == 0.5:
+		ip.sqrt()
+	else:
+		ip.pow(exponent)
+
+class BufferPool:
+	"""keeps released CLIJ2 buffers for reuse, keyed by shape and type. Once more than maxBytes are resident,
+	the least recently released buffers are freed. Like every other CLIJ2 call, use it with gpuLock held"""
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.free = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.bytesResident = 0
+
+	def key(self, dimensions, nativeType):
+		dimensions = [int(d) for d in dimensions]
+		return tuple(dimensions + [1]*(3-len(dimensions))), str(nativeType)
+
+	def lease(self, dimensions, nativeType):
+		"""returns a buffer of the given shape and type, reusing a released one if there is one"""
+		key = self.key(dimensions, nativeType)
+		buffers = self.free.get(key)
+		if buffers:
+			self.hits += 1
+			buffer = buffers.pop()
+			if not buffers:
+				del self.free[key]
+			return buffer
+		self.misses += 1
+		buffer = clij2.create(dimensions, nativeType)
+		self.bytesResident += buffer.getSizeInBytes()
+		return buffer
+
+	def leaseLike(self, buffer):
+		return self.lease(buffer.getDimensions(), buffer.getNativeType())
+
+	def push(self, imp):
+		"""pushes an image, counting its buffer as resident so it can be released to the pool"""
+		buffer = clij2.push(imp)
+		self.bytesResident += buffer.getSizeInBytes()
+		return buffer
+
+	def release(self, buffer):
+		"""hands a buffer back for reuse, the caller must not use it again"""
+		if buffer is None:
+			return
+		key = self.key(buffer.getDimensions(), buffer.getNativeType())
+		buffers = self.free.pop(key, [])
+		if buffer in buffers:
+			print "buffer released twice"
+		else:
+			buffers.append(buffer)
+		#move the key to the most recently used end
+		self.free[key] = buffers
+		self.trim(self.maxBytes)
+
+	def trim(self, maxBytes):
+		while self.bytesResident > maxBytes and self.free:
+			key, buffers = self.free.popitem(last=False)
+			for buffer in buffers:
+				self.bytesResident -= buffer.getSizeInBytes()
+				buffer.close()
+
+	def clear(self):
+		"""frees every released buffer, leased ones stay valid"""
+		self.trim(0)
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "bytesResident": self.bytesResident}
+
+def selectBackend():
+	"""uses CLIJ2 on the GPU when it can be started, otherwise the CPU backend"""
+	if clijInstalled:
+		try:
+			gpu = CLIJ2.getInstance()
+			gpu.clear()
+			return gpu, CLIJ.getInstance(), True
+		except:
+			print "No OpenCL device could be started, EZ Peeler will run on the CPU"
+	else:
+		print """CLIJ is not installed, so EZ Peeler will run on the CPU. To use the GPU:
 	
-	"""Calculates a areamap from the heightmap"""
-
-	imp2= imp1.duplicate()
-	imp3= imp1.duplicate()
-	imp4= imp1.duplicate()
-	imp5= imp1.duplicate()
+	1. Click Help>Update> Manage update sites
+	2. Make sure the "clij" and "clij2" update sites are selected.
+	3. Click Close> Apply changes.
+	4. Close and reopen ImageJ"""
+	cpu = CPUBackend()
+	return cpu, cpu, False
+
+def compareBackends():
+	"""runs every backend operation on a noisy test stack on both the GPU and the CPU, and reports the operations whose largest
+	or mean difference is over its tolerance. Returns the failure messages, empty if every operation agrees"""
+	cpu = CPUBackend()
+	ramp = IJ.createImage("Backend check ramp", "8-bit ramp", 96, 64, 12)
+	imp = ramp.duplicate()
+	IJ.run(imp, "Add Specified Noise...", "stack standard=40")
+	surfaceMap = IJ.createImage("Backend check heightmap", "32-bit ramp", 96, 64, 1)
+	noisyMap = surfaceMap.duplicate()
+	IJ.run(noisyMap, "Add Specified Noise...", "standard=0.5")
+
+	#(test images, operation, largest difference, mean difference) allowed. Operations on two images get two different ones, so swapped
+	#or ignored operands show. Blurs round differently, and the CPU median and minimum filters use circular kernels in place of boxes
+	#and spheres, so only their mean difference is bounded
+	checks = OrderedDict()
+	checks["blur2D"] = (imp, lambda b, s, d: b.blur2D(s, d, 2, 2), 2, 0.5)
+	checks["blur3D"] = (imp, lambda b, s, d: b.blur3D(s, d, 2, 2, 2), 2, 0.5)
+	checks["median2DBox"] = (imp, lambda b, s, d: b.median2DBox(s, d, 2, 2), None, 5)
+	checks["median3DBox"] = (imp, lambda b, s, d: b.median3DBox(s, d, 2, 2, 2), None, 5)
+	checks["minimum3DSphere"] = (imp, lambda b, s, d: b.minimum3DSphere(s, d, 2, 2, 2), None, 5)
+	checks["power"] = (surfaceMap, lambda b, s, d: b.power(s, d, 2), 1e-3, 1e-4)
+	checks["addImageAndScalar"] = (surfaceMap, lambda b, s, d: b.addImageAndScalar(s, d, 3.5), 1e-4, 1e-5)
+	checks["multiplyImageAndScalar"] = (surfaceMap, lambda b, s, d: b.multiplyImageAndScalar(s, d, 0.5), 1e-4, 1e-5)
+	checks["addImages"] = ((surfaceMap, noisyMap), lambda b, s, t, d: b.addImages(s, t, d), 1e-4, 1e-5)
+	checks["multiplyImages"] = ((surfaceMap, noisyMap), lambda b, s, t, d: b.multiplyImages(s, t, d), 1e-3, 1e-4)
+	checks["subtract"] = ((imp, ramp), lambda b, s, t, d: b.subtract(s, t, d), 0, 0)
+	for sobeltype in edgeKernels:
+		checks["convolve " + sobeltype] = (imp, lambda b, s, d, sobeltype=sobeltype: b.convolve(s, edgeKernel(b, sobeltype, b is not cpu), d), 0, 0)
+	checks["resliceTop"] = (imp, None, 0, 0)
+
+	failures = []
+	for name, (tests, operation, maxTolerance, meanTolerance) in checks.items():
+		if not isinstance(tests, tuple):
+			tests = (tests,)
+		results = []
+		for backend in [clij2, cpu]:
+			sources = [backend.push(test) for test in tests]
+			src = sources[0]
+			if operation is None:
+				dst = backend.create([src.getWidth(), src.getDepth(), src.getHeight()], src.getNativeType())
+				backend.resliceTop(src, dst)
+			else:
+				dst = backend.create(src)
+				operation(backend, *(sources + [dst]))
+			results.append(backend.pull(dst))
+			for source in sources:
+				source.close()
+			dst.close()
+		difference = StackStatistics(ImageCalculator().run("Difference create 32-bit stack", results[0], results[1]))
+		print "%s: max difference %g, mean difference %g" % (name, difference.max, difference.mean)
+		if (maxTolerance is not None and difference.max > maxTolerance) or difference.mean > meanTolerance:
+			failures.append("%s differs by up to %g (mean %g) between the GPU and the CPU" % (name, difference.max, difference.mean))
+
+	#the statistics and default threshold found on the GPU must match those of the same stack on the CPU
+	for name, andOp, settings in [("8-bit", 0xFF, "8-bit ramp"), ("16-bit", 0xffff, "16-bit ramp")]:
+		test = IJ.createImage("Backend check " + name, settings, 96, 64, 12)
+		IJ.run(test, "Add Specified Noise...", "stack standard=" + str(andOp/6))
+		src = bufferPool.push(test)
+		gpuStats, gpuThreshold = deviceStatistics(src, andOp)
+		bufferPool.release(src)
+		histogram = StackHistogram()
+		for i in xrange(1, test.getStackSize()+1):
+			histogram.add(test.getStack().getProcessor(i))
+		cpuStats, cpuThreshold = histogram.statistics()
+		print "statistics %s: threshold %g on the GPU, %g on the CPU" % (name, gpuThreshold, cpuThreshold)
+		if (gpuStats.min, gpuStats.max, list(gpuStats.histogram), gpuThreshold) != (cpuStats.min, cpuStats.max, list(cpuStats.histogram), cpuThreshold) or abs(gpuStats.mean-cpuStats.mean) > 1e-6:
+			failures.append("statistics of %s stacks differ between the GPU (threshold %g) and the CPU (threshold %g)" % (name, gpuThreshold, cpuThreshold))
+
+	if failures:
+		print "Backend check failed:\n" + "\n".join(failures)
+		if not GraphicsEnvironment.isHeadless():
+			errorDialog("The CPU backend does not match the GPU:\n" + "\n".join(failures))
+	else:
+		print "Backend check passed"
+	return failures
 
-	#work out change in height in several directions
-	IJ.run(imp2, "Convolve...", "text1=[0\n1\n-1] ")
-	IJ.run(imp3, "Convolve...", "text1=[0 0 0\n0 1 -1\n0 0 0] ")
-	IJ.run(imp4, "Convolve...", "text1=[-1\n1\n0] ")
-	IJ.run(imp5, "Convolve...", "text1=[0 0 0\n-1 1 0\n0 0 0] ")
-
-	
-	#push to graphics card
-	simp2=clij2.push(imp2)
-	simp3=clij2.push(imp3)
-	simp4=clij2.push(imp4)
-	simp5=clij2.push(imp5)
-	
-	dimp2=clij2.create(simp2)
-	dimp3=clij2.create(simp3)
-	dimp4=clij2.create(simp4)
-	dimp5=clij2.create(simp5)
 
+def edgeLengths(heights, dx, dy, scale):
+	"""returns the length of the surface edge from each pixel to its neighbour at (x+dx, y+dy), with a pixel spacing of scale.
+	Pixels on the border take their own height as the missing neighbour, as ImageJ's convolver does"""
+	edges = heights.duplicate()
+	edges.copyBits(heights, -dx, -dy, Blitter.COPY)
 	# height^2 + scale^2 = edgelength^2
-	
-	# height^2
-	clij2.power(simp2,dimp2, 2)
-	clij2.power(simp3,dimp3, 2)
-	clij2.power(simp4,dimp4, 2)
-	clij2.power(simp5,dimp5, 2)
-
-	# height^2 + scale^2
-	clij2.addImageAndScalar(dimp2, simp2, yscale*yscale)
-	clij2.addImageAndScalar(dimp3, simp3, xscale*xscale)
-	clij2.addImageAndScalar(dimp4, simp4, yscale*yscale)
-	clij2.addImageAndScalar(dimp5, simp5, xscale*xscale)
-
-	# Calculate edgelength
-	clij2.power(simp2,dimp2, 0.5)
-	clij2.power(simp3,dimp3, 0.5)
-	clij2.power(simp4,dimp4, 0.5)
-	clij2.power(simp5,dimp5, 0.5)
-	
-	dimp6=clij2.create(dimp2)
-	dimp7=clij2.create(dimp4)
-	
-	#trianglular polygon area = Xedgelength x Yedgelength/2 
-	#
-	clij2.multiplyImages(dimp2, dimp3, dimp6)
-	clij2.multiplyImages(dimp4, dimp5, dimp7)
-	clij2.addImages(dimp7, dimp6, dimp2)
-	clij2.multiplyImageAndScalar(dimp2, dimp3, 0.5)
+	edges.copyBits(heights, 0, 0, Blitter.SUBTRACT)
+	edges.sqr()
+	edges.add(scale*scale)
+	edges.sqrt()
+	return edges
 
-	#pull result from GPU
-	areamapIMP=clij2.pull(dimp3)
-	
-	#cleanup, free GPU memory
-	simp2.close()
-	simp3.close()
-	simp4.close()
-	simp5.close()
+def areamap(imp1, xscale, yscale):
 	
-	dimp2.close()
-	dimp3.close()
-	dimp4.close()
-	dimp5.close()
-	dimp6.close()
-	dimp7.close()
-	return areamapIMP
-
-
-
-def extractChannel(imp, nChannel, nFrame, changeBitType):
-	"""extract a channel from the image, returning a new 16 bit imagePlus labelled with the channel name"""
-
+	"""Calculates a areamap from the heightmap in one pass on the CPU, without intermediate images or GPU buffers"""
+
+	heights = imp1.getProcessor().convertToFloat()
+
+	#trianglular polygon area = Xedgelength x Yedgelength/2, for the triangles below right and above left of each pixel
+	area = edgeLengths(heights, 0, 1, yscale)
+	area.copyBits(edgeLengths(heights, 1, 0, xscale), 0, 0, Blitter.MULTIPLY)
+	upperLeft = edgeLengths(heights, 0, -1, yscale)
+	upperLeft.copyBits(edgeLengths(heights, -1, 0, xscale), 0, 0, Blitter.MULTIPLY)
+	area.copyBits(upperLeft, 0, 0, Blitter.ADD)
+	area.multiply(0.5)
+	return ImagePlus("area map", area)
+
+def squaredDistances(stack, toMask, cal, far):
+	"""squared calibrated distance from every voxel of a mask stack to the nearest background voxel, or to the nearest mask voxel
+	if toMask is set, 0 on that side. imglib2's exact separable transform runs over the whole stack in Java, weighting x, y and z
+	by the pixel width, height and depth. Voxels with nothing to measure to are left at about far"""
+	width = stack.getWidth()
+	height = stack.getHeight()
+	depth = stack.getSize()
+	distances = PlanarImgs.floats(array('l', [width, height, depth]))
+	def costSlice(i):
+		plane = stack.getProcessor(i)
+		if toMask:
+			plane.setThreshold(0, 0, ImageProcessor.NO_LUT_UPDATE)
+		else:
+			plane.setThreshold(1, 255, ImageProcessor.NO_LUT_UPDATE)
+		cost = FloatProcessor(width, height, distances.getPlane(i-1).getCurrentStorageArray())
+		cost.setValue(far)
+		cost.fill(plane.createMask())
+	parallelSlices(depth, costSlice)
+	pool = Executors.newFixedThreadPool(Prefs.getThreads())
+	try:
+		DistanceTransform.transform(distances, DistanceTransform.DISTANCE_TYPE.EUCLIDIAN, pool, Prefs.getThreads(),
+			array('d', [cal.pixelWidth*cal.pixelWidth, cal.pixelHeight*cal.pixelHeight, cal.pixelDepth*cal.pixelDepth]))
+	finally:
+		pool.shutdown()
+	return [FloatProcessor(width, height, distances.getPlane(z).getCurrentStorageArray()) for z in xrange(depth)]
+
+def distancePeel(mask, gaussian, depthOffset, stackThickness, cal):
+	"""keeps the voxels of an XY mask that are more than depthOffset and at most depthOffset+stackThickness voxel layers from its surface,
+	by thresholding its exact calibrated Euclidean distance transform plane by plane, so the cost is the same for any offset and thickness.
+	With a negative offset, voxels outside the mask count a layer less than minus their distance to it, so the layer just above is at 0"""
+	stack = mask.getStack()
+	width = mask.getWidth()
+	height = mask.getHeight()
+	depth = stack.getSize()
+	step = cal.pixelDepth
+	lower = depthOffset*step
+	upper = (depthOffset+stackThickness)*step
+	value = int(gaussian)
+	#more than the squared diagonal of the stack
+	far = (width*cal.pixelWidth)**2 + (height*cal.pixelHeight)**2 + (depth*step)**2 + 1
+
+	inside = squaredDistances(stack, False, cal, far)
+	outside = None
+	if lower < 0:
+		outside = squaredDistances(stack, True, cal, far)
+
+	peel = ImageStack.create(width, height, depth, 8)
+	def peelSlice(i):
+		keep = ByteProcessor(width, height)
+		#inside the mask, between the offset and the offset plus the thickness
+		if upper > 0:
+			distance = inside[i-1]
+			distance.setThreshold(Math.nextUp(max(lower, 0.0)**2), upper*upper, ImageProcessor.NO_LUT_UPDATE)
+			keep.copyBits(distance.createMask(), 0, 0, Blitter.OR)
+		#outside it, a signed distance of step-distance above the offset and at most offset plus thickness
+		if outside is not None:
+			low = Math.nextUp(0.0)
+			if upper < 0:
+				low = (step-upper)**2
+			high = Math.nextDown((step-lower)**2)
+			if low <= high:
+				distance = outside[i-1]
+				distance.setThreshold(low, high, ImageProcessor.NO_LUT_UPDATE)
+				keep.copyBits(distance.createMask(), 0, 0, Blitter.OR)
+		plane = peel.getProcessor(i)
+		plane.setValue(value)
+		plane.fill(keep)
+	parallelSlices(depth, peelSlice)
+	return ImagePlus("Binary Stack", peel)
+
+def channelView(imp, nChannel, nFrame):
+	"""returns the slices of one channel and frame as an imagePlus that shares the planes of imp, without copying them"""
 	stack = imp.getImageStack()
 	ch=ImageStack(imp.width, imp.height)
-	for i in range(imp.getNSlices()):
+	for i in range(1, imp.getNSlices() + 1):
 		index = imp.getStackIndex(nChannel, i, nFrame)
 		ch.addSlice(str(i), stack.getProcessor(index))
-	imp3 = ImagePlus("Channel " + str(nChannel), ch).duplicate()
-	stats =StackStatistics(imp3) 
-	IJ.setMinAndMax(imp3, stats.min, stats.max)
-	if andOp == 0xFF:
-		ImageConverter(imp3).convertToGray8()
-	else:
-		ImageConverter(imp3).convertToGray16() 	
+	view = ImagePlus("Channel " + str(nChannel), ch)
+	view.setCalibration(imp.getCalibration())
+	return view
+
+def targetBitDepth(changeBitType):
+	"""the bit depth the segmentation channel is converted to"""
+	if changeBitType == 0xFF:
+		return 8
+	return 16
+
+def extractChannel(imp, nChannel, nFrame, changeBitType):
+	"""extract a channel from the image, returning an 8 or 16 bit imagePlus labelled with the channel name.
+	If the channel already has that bit depth its planes are shared, otherwise each is scaled from the stack min and max in one pass"""
+
+	view = channelView(imp, nChannel, nFrame)
+	bitDepth = targetBitDepth(changeBitType)
+	if view.getBitDepth() == bitDepth:
+		return view
+	stack = view.getStack()
+	#like ImageConverter, 8-bit and 16-bit sources are widened without scaling
+	scale = not (view.getBitDepth() == 8 and bitDepth == 16)
+	if scale:
+		#the min and max must be known before the first plane is scaled, so they take their own pass, on CPU threads
+		planeStats = [None]*stack.getSize()
+		def planeRange(i):
+			planeStats[i-1] = ImageStatistics.getStatistics(stack.getProcessor(i), Measurements.MIN_MAX, None)
+		parallelSlices(stack.getSize(), planeRange)
+		stackMin = min([stat.min for stat in planeStats])
+		stackMax = max([stat.max for stat in planeStats])
+	converted = ImageStack(view.width, view.height)
+	for i in xrange(1, stack.getSize()+1):
+		ip = stack.getProcessor(i)
+		if scale:
+			ip.setMinAndMax(stackMin, stackMax)
+		if bitDepth == 8:
+			ip = ip.convertToByte(scale)
+		else:
+			ip = ip.convertToShort(scale)
+		converted.addSlice(stack.getSliceLabel(i), ip)
+	imp3 = ImagePlus(view.getTitle(), converted)
+	imp3.setCalibration(view.getCalibration())
 	return imp3
 
 def extractFrame(imp, nFrame):
-	"""extract a frame from the image, returning a new 16 bit imagePlus labelled with the channel name"""
+	"""extract a frame from the image, returning a composite imagePlus that shares the planes of imp"""
 
 	stack = imp.getImageStack()
 	fr=ImageStack(imp.width, imp.height)
@@ -164,88 +669,196 @@ def extractFrame(imp, nFrame):
 		for nChannel in range(1, imp.getNChannels()+1):
 			index = imp.getStackIndex(nChannel, i, nFrame)
 			fr.addSlice(str(i), stack.getProcessor(index))
-	imp3 = ImagePlus("Frame " + str(nFrame), fr).duplicate()
+	imp3 = ImagePlus("Frame " + str(nFrame), fr)
 	imp3.setDimensions(imp.getNChannels(), imp.getNSlices(), 1)
 	comp = CompositeImage(imp3, CompositeImage.COMPOSITE)  
-	comp.show()
+	if not headless:
+		comp.show()
 	return comp
 
+def deviceConvert(src, bitDepth):
+	"""converts a pushed 8 or 16 bit stack to bitDepth on the GPU like ImageConverter, scaling 16 to 8 bit from the stack min and max.
+	Returns the converted buffer and releases src, or src itself if no conversion is needed"""
+	if src.getNativeType() == nativeType(bitDepth):
+		return src
+	dst = bufferPool.lease(src.getDimensions(), nativeType(bitDepth))
+	if bitDepth == 16:
+		clij2.copy(src, dst)
+	else:
+		stackMin = clij2.getMinimumOfAllPixels(src)
+		stackMax = clij2.getMaximumOfAllPixels(src)
+		scale = 256.0/(stackMax-stackMin+1)
+		#the float to 8-bit copy truncates and saturates, so offsetting by half a level rounds like ImageJ
+		scaled = bufferPool.lease(src.getDimensions(), NativeTypeEnum.Float)
+		clij2.addImageAndScalar(src, scaled, -stackMin + 0.5/scale)
+		clij2.multiplyImageAndScalar(scaled, dst, scale)
+		bufferPool.release(scaled)
+	bufferPool.release(src)
+	return dst
+
+def nativeType(bitDepth):
+	"""the CLIJ2 pixel type of an ImageJ bit depth"""
+	if bitDepth == 8:
+		return NativeTypeEnum.UnsignedByte
+	if bitDepth == 16:
+		return NativeTypeEnum.UnsignedShort
+	return NativeTypeEnum.Float
 
 
-def smoothFilter(imp, filtertype, radius):
-	"""iterate through slices to perform either gaussian or median filter"""
+
+def smoothFilter(imp, filtertype, radius, bitDepth=None):
+	"""iterate through slices to perform either gaussian or median filter, returning None if the stack could not be sent to the GPU.
+	If bitDepth is given the stack is converted to it on the GPU before filtering"""
+	src = None
 	try:
-		src = clij2.push(imp)
-		dst = clij2.create(src)
+		src = bufferPool.push(imp)
+		dst = bufferPool.leaseLike(src)
 	except:	
 		try:
-		
+			#free the pooled buffers before trying again
+			bufferPool.release(src)
+			bufferPool.clear()
 			Thread.sleep(500)
+			src = bufferPool.push(imp)
+			dst = bufferPool.leaseLike(src)
 			print("Succeeded to sending to graphics card on the second time...")
-			src = clij2.push(imp)
-			dst = clij2.create(src)
 		except:
-			errorDialog("""Could not send image to graphics card, it may be too large!
-		
-			Easy solutions: Try	processing as 8-bit, cropping or scaling the image, or
-			select a different CLIJ2 GPU.
-
-			This issue is often intermittent, so trying again may also work! 
+			#firstStage falls back to filtering the stack in tiles
+			bufferPool.release(src)
+			print "Could not send image to graphics card, processing it in tiles instead\n" + str(clij2.reportMemory())
+			return None
 
-			See the "Big Images on x graphics cards' notes at:
-			https://clij2.github.io/clij2-docs/troubleshooting for more solutions
-			
-			"""	+ str(clij2.reportMemory()) )
-			"""
-
-			put non clij filters here
-			if filtertype == "Gaussian":
-				clij2.blur(src, dst, radius, radius)
-				#imp = clij2.pull(dst)
-			if filtertype == "Median":
-				clij2.medianBox(src, dst, radius, radius,0)
-				#imp = clij2.pull(dst)
-			if filtertype == "3D Median":
-				clij2.medianBox(src, dst, radius, radius, radius)
-				#imp = clij2.pull(dst)
-			"""
+	if bitDepth is not None and gpuBackend:
+		bufferPool.release(dst)
+		src = deviceConvert(src, bitDepth)
+		dst = bufferPool.leaseLike(src)
+	deviceFilter(src, dst, filtertype, radius)
+	
+	bufferPool.release(src)
+	
+	#return as imagePlus
+	return dst
 
+def deviceFilter(src, dst, filtertype, radius):
+	"""applies the chosen smoothing filter from src to dst"""
 	if filtertype == "2D Gaussian":
 		clij2.blur2D(src, dst, radius, radius)
-		#imp = clij2.pull(dst)
 	if filtertype == "3D Gaussian":
 		clij2.blur3D(src, dst, radius, radius, radius)
-		#imp = clij2.pull(dst)
 	if filtertype == "Median":
 		clij2.median2DBox(src, dst, radius, radius)
-		#imp = clij2.pull(dst)
 	if filtertype == "3D Median":
 		clij2.median3DBox(src, dst, radius, radius, radius)
-		#imp = clij2.pull(dst)
-	
-	src.close()
-	
-	#return as imagePlus
-	return dst
-def findEdge(imp3, sobeltype):
-
-
-	if sobeltype =="2D Sobel":
-		IJ.run(imp3, "Find Edges", "")
-	if sobeltype =="1D Sobel":
-		IJ.run(imp3, "Convolve...", "text1=[1 2 1 \n0 0 0 \n-1 -2 -1\n] normalize stack")
-	if sobeltype =="1 X 3 Gradient":
-		IJ.run(imp3, "Convolve...", "text1=[1\n0\n-1] normalize stack")
-	if sobeltype =="Laplace filter":
-		IJ.run(imp3, "Convolve...", "text1=[-1 -1 -1\n-1 8 -1\n-1 -1 -1] normalize stack")
-	if sobeltype =="1 X 7 Gradient":
-		IJ.run(imp3, "Convolve...", "text1=[1\n1\n1\n0\n-1\n-1\n-1] normalize stack")
-	if sobeltype =="3 X 7 Gradient":
-		IJ.run(imp3, "Convolve...", "text1=[1 1 1\n1 1 1\n1 1 1\n0 0 0\n-1 -1 -1\n-1 -1 -1\n-1 -1 -1] normalize stack")
-	if sobeltype =="1D mexican hat":
-		IJ.run(imp3, "Convolve...", "text1=[-1 \n -2 \n 1 \n 4 \n 1 \n -2 \n -1] normalize stack")
+	if filtertype == "none":
+		clij2.copy(src, dst)
+
+def filterHalo(filtertype, radius):
+	"""how many pixels beyond a tile the chosen filter reads"""
+	if filtertype in ["2D Gaussian", "3D Gaussian"]:
+		return int(math.ceil(4*radius))
+	if filtertype in ["Median", "3D Median"]:
+		return int(radius)
+	return 0
+
+def deviceBudget():
+	"""bytes of GPU memory a stage may use"""
+	return clij.getGPUMemoryInBytes()*gpuMemoryFraction
+
+def fitsOnDevice(nBytes):
+	"""whether a stage needing nBytes of GPU buffers can run untiled"""
+	return not gpuBackend or nBytes <= deviceBudget()
+
+def tileSide(bytesPerColumn, halo):
+	"""side of the square XY tiles that fit in the GPU budget, when every XY column of a tile (halo included) needs bytesPerColumn"""
+	side = int(math.sqrt(deviceBudget()/bytesPerColumn)) - 2*halo
+	return max(side, 32)
+
+def tileRanges(size, tile, halo):
+	"""splits 0 to size into tiles of at most tile pixels, returning (start, end, haloStart, haloEnd) for each"""
+	ranges = []
+	for start in xrange(0, size, tile):
+		end = min(start+tile, size)
+		ranges.append((start, end, max(0, start-halo), min(size, end+halo)))
+	return ranges
+
+def tiledFilterReslice(imp, filtertype, radius):
+	"""filters and reslices a stack too large for the GPU in XY tiles, with halos as wide as the filter reads, stitching the resliced tiles on the host"""
+	width = imp.getWidth()
+	height = imp.getHeight()
+	depth = imp.getStackSize()
+	halo = filterHalo(filtertype, radius)
+
+	#each tile needs its source, filtered and resliced buffers on the GPU
+	side = tileSide(3*depth*imp.getBitDepth()/8, halo)
+	stack = imp.getStack()
+	resliced = ImageStack.create(width, depth, height, imp.getBitDepth())
+
+	for x0, x1, hx0, hx1 in tileRanges(width, side, halo):
+		for y0, y1, hy0, hy1 in tileRanges(height, side, halo):
+			src = bufferPool.push(ImagePlus("Tile", stack.crop(hx0, hy0, 0, hx1-hx0, hy1-hy0, depth)))
+			dst = bufferPool.leaseLike(src)
+			deviceFilter(src, dst, filtertype, radius)
+			bufferPool.release(src)
+
+			#drop the halo, then reslice what is left and paste it into the full resliced stack
+			interior = bufferPool.lease([x1-x0, y1-y0, depth], dst.getNativeType())
+			clij2.crop3D(dst, interior, x0-hx0, y0-hy0, 0)
+			bufferPool.release(dst)
+			tileStack = reslicedView(interior).getStack()
+			bufferPool.release(interior)
+			for j in xrange(y1-y0):
+				resliced.getProcessor(y0+j+1).insert(tileStack.getProcessor(j+1), x0, 0)
+	return ImagePlus("Resliced", resliced)
+
+#the XZ edge filters that are plain convolutions, as (width, height, kernel) in ImageJ's Convolve... order
+edgeKernels = {
+	"1D Sobel": (3, 3, [1, 2, 1, 0, 0, 0, -1, -2, -1]),
+	"1 X 3 Gradient": (1, 3, [1, 0, -1]),
+	"Laplace filter": (3, 3, [-1, -1, -1, -1, 8, -1, -1, -1, -1]),
+	"1 X 7 Gradient": (1, 7, [1, 1, 1, 0, -1, -1, -1]),
+	"3 X 7 Gradient": (3, 7, [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, -1, -1, -1, -1, -1, -1, -1, -1, -1]),
+	"1D mexican hat": (1, 7, [-1, -2, 1, 4, 1, -2, -1])}
+
+def findEdge(imp3, sobeltype, histogram=None):
+	"""runs the XZ edge filter on every slice of the resliced stack on CPU threads, giving the same result as ImageJ's
+	Find Edges (2D Sobel) or Convolve... with normalize. Each filtered slice is added to histogram, if one is given"""
+	stack = imp3.getStack()
+	if sobeltype not in edgeKernels and sobeltype != "2D Sobel" and histogram is None:
+		return imp3
+	def edgeSlice(i):
+		ip = stack.getProcessor(i)
+		if sobeltype == "2D Sobel":
+			ip.findEdges()
+		elif sobeltype in edgeKernels:
+			kw, kh, kernel = edgeKernels[sobeltype]
+			Convolver().convolve(ip, array('f', kernel), kw, kh)
+		stack.setPixels(ip.getPixels(), i)
+		if histogram is not None:
+			histogram.add(ip)
+	parallelSlices(stack.getSize(), edgeSlice)
 	return imp3
-	
+
+def edgeKernel(backend, sobeltype, onDevice):
+	"""pushes the kernel of an edge filter to a backend, as a one slice 3D buffer when onDevice so 3D stacks are convolved slice by slice.
+	The backend may be wrapped by the profiler, so callers say whether it is the GPU"""
+	kw, kh, kernel = edgeKernels[sobeltype]
+	plane = backend.push(ImagePlus("Edge kernel", FloatProcessor(kw, kh, array('f', kernel))))
+	if not onDevice:
+		return plane
+	buffer = backend.create([kw, kh, 1], NativeTypeEnum.Float)
+	backend.copySlice(plane, buffer, 0)
+	plane.close()
+	return buffer
+
+def deviceEdge(src, sobeltype):
+	"""runs a convolution edge filter on a resliced stack before it is pulled, returning a buffer of the same type.
+	Kernels sum to 0, so normalizing does not scale them, and integer sums are clipped to the pixel type like Convolve... does"""
+	kernel = edgeKernel(clij2, sobeltype, gpuBackend)
+	dst = bufferPool.leaseLike(src)
+	clij2.convolve(src, kernel, dst)
+	kernel.close()
+	return dst
+
 def getOptions1(imp):
 	"""Get user defined options for image preprocessing"""
                       
@@ -305,6 +918,7 @@ def getOptions1(imp):
 	gd.addChoice("Edge detection filter", sobel, sobel[0])
 	GPUs=clij.getAvailableDeviceNames()
 	gd.addChoice("CLIJ2 GPU choice", GPUs, GPUs[0])
+	gd.addCheckbox("Detect surface on the GPU (when no edge detection filter is used)", True)
 	 
 	gd.showDialog()
 	
@@ -316,6 +930,7 @@ def getOptions1(imp):
 	smoothsize = gd.getNextChoice()
 	sobeltype = gd.getNextChoice()
 	GPU = gd.getNextChoice()
+	deviceSurface = gd.getNextBoolean()
 	#assign bitwise operator to convert signed to unsigned stack image values.
 	if changeBitType==1:
 		andOp = 0xFF
@@ -331,7 +946,7 @@ def getOptions1(imp):
 		oked=1
 	else:
 		oked=0
-	return channel, frame, filtertype, smoothsize, canceled, sobeltype, andOp, GPU, oked
+	return channel, frame, filtertype, smoothsize, canceled, sobeltype, andOp, GPU, oked, deviceSurface
 
 
 def getOptions2(imp, maxPixel,height, stack,andOp, width,defaultThreshold):
@@ -362,63 +977,33 @@ def getOptions2(imp, maxPixel,height, stack,andOp, width,defaultThreshold):
 	gd.addNumericField("Interpolation interval ", 8, 0)
 	gd.addSlider("Slices to ignore:", 0, int(height),0)
 
-	gd.setModal(False)
-	gd.showDialog()
-	
-
 	sliders=gd.getSliders()
-	
-	
 	sliderValue=sliders.get(0)
 	sliderSlice=sliders.get(1)
-	sliceSlid1=sliderSlice.getValue()
-	slid1=sliderValue.getValue()
+	drawn=[None, None]
 
-	slid2=slid1
-	sliceSlid2=sliceSlid1
-	imp.setSlice(sliceSlid1)
-	widths, heights= findEpidermis(stack.getPixels(sliceSlid1), width, height, slid1, False, 8, 0, andOp)
-	
-	#draw a preview segmentation ROI to imp 
-	proi = PolygonRoi(widths, heights, len(widths), Roi.POLYLINE)
-	proi.setPosition(sliceSlid1)
-	proi.setStrokeColor(Color.green)
-	overlay=Overlay()
-	overlay.add(proi)
-	imp.setOverlay(overlay)
-	imp.show()
-	
-	while ((not gd.wasCanceled()) and not (gd.wasOKed())):
-		sliders=gd.getSliders()
-		sliderValue=sliders.get(0)
-		sliderSlice=sliders.get(1)
-		sliceSlid1=int(sliderSlice.getValue())
+	def preview(current):
 		slid1=sliderValue.getValue()
-	
-		if (slid2!=slid1 or sliceSlid2!=sliceSlid1):
-			slid2=slid1
-			sliceSlid2=sliceSlid1
-			widths, heights= findEpidermis(stack.getPixels(sliceSlid1), width, height, slid1, False, 8, 0, andOp)
-			
-			#draw a preview segmentation ROI to imp 
-			
-			proi = PolygonRoi(widths, heights, len(widths), Roi.POLYLINE)
-			proi.setPosition(sliceSlid1)
-			proi.setStrokeColor(Color.green)
-			overlay=Overlay()
-			overlay.add(proi)
-			imp.setOverlay(overlay)
-			imp.setSlice(sliceSlid1)
-			imp.show()
-			Thread.sleep(50)
-			
-			continue
-	
-	
-	
-		slid2=slid1
-		sliceSlid2=sliceSlid1
-		Thread.sleep(50)
+		sliceSlid1=int(sliderSlice.getValue())
+		if drawn==[slid1, sliceSlid1]:
+			return
+		widths, heights= epidermisVertices(thresholdIndex(imp, 0, andOp).sliceHeights(sliceSlid1-1, slid1, height), width, height)
+		#a newer slider position has arrived, leave the drawing to its preview
+		if not current():
+			return
+		drawn[:]=[slid1, sliceSlid1]
+		
+		#draw a preview segmentation ROI to imp 
+		proi = PolygonRoi(widths, heights, len(widths), Roi.POLYLINE)
+		proi.setPosition(sliceSlid1)
+		proi.setStrokeColor(Color.green)
+		overlay=Overlay()
+		overlay.add(proi)
+		imp.setOverlay(overlay)
+		imp.setSlice(sliceSlid1)
+		imp.show()
+
+	previewDialog(gd, preview)
 	useOtsu = gd.getNextBoolean()
 	minThreshold = gd.getNextNumber()
 	displaySlice = gd.getNextNumber()
@@ -440,6 +1025,14 @@ def getOptions2(imp, maxPixel,height, stack,andOp, width,defaultThreshold):
 		
 	return minThreshold, interpolation, canceled, interpolRes, topSlice, oked,useOtsu
 
+def divergenceMask(pixels, width, height, heightDiffMax):
+	"""returns a byteProcessor set to 255 wherever the divergence map differs from the smoothed surface by more than heightDiffMax"""
+	divergence=FloatProcessor(width, height, pixels[:])
+	divergence.abs()
+	#the threshold is inclusive, so start it just above heightDiffMax
+	divergence.setThreshold(Math.nextUp(float(heightDiffMax)), Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+	return divergence.createMask()
+
 def getOptions3(imp, pixels, imp3, epidermisHeightsFull):
 	gd = GenericDialogPlus("EZ Peeler -Error correction, epidermis extraction and reslicing")
 		
@@ -447,7 +1040,9 @@ def getOptions3(imp, pixels, imp3, epidermisHeightsFull):
 					autocorrection.
 	
 					The 'Hole removal' option removes points where the height diverges massively
-					from the smoothed surface depth, which can correct segmentation errors
+					from the smoothed surface depth, which can correct segmentation errors.
+					Holes are filled from their surroundings by inpainting, or by the older
+					repeated Gaussian blur.
 
 					These options allow the user to specify how deep below the surface to
 					peel.
@@ -462,18 +1057,13 @@ def getOptions3(imp, pixels, imp3, epidermisHeightsFull):
 					Using a Gaussian filter on the render mask, reduces the woodgrain effect of
 					images.""")
 	gd.addSlider("Current visible slice",1, imp3.getStackSize(), int(imp3.getStackSize()/2))
-	gd.addCheckbox("Erode filter peel? (Sometimes buggy with negative values)", False)
+	gd.addCheckbox("Erode filter peel? (exact calibrated distance from the surface)", False)
 	gd.addSlider("y offset (in voxel layers)", -imp3.getHeight(), imp3.getHeight(), 4, 1)
-	gd.addNumericField("x and z offset (in voxels for erosion)", 1, 1)
 	gd.addSlider("Epidermis y thickness (in voxel layers)",0, imp3.getHeight()*2, 8, 1)
-	gd.addNumericField("Epidermis x and z thickness (in voxel layers)", 1, 1)
 	gd.addCheckbox("Gaussian filter render mask?", True)
 	gd.addCheckbox("Hole removal", True)
 	gd.addSlider("Hole divergence threshold", 0, 50, 15, 0.1);
-	
-	gd.setModal(False)
-	gd.showDialog()
-	#set up sliders
+	gd.addChoice("Hole filling", ["inpaint", "blur"], "inpaint")
 	
 	sliders=gd.getSliders()
 	
@@ -482,130 +1072,70 @@ def getOptions3(imp, pixels, imp3, epidermisHeightsFull):
 	sliderThick=sliders.get(2)
 	sliderValue=sliders.get(3)
 
-	sliceSlid1=sliderSlice.getValue()
-	offsetSlid1=sliderOffset.getValue()
-	thickSlid1=sliderThick.getValue()
-	slid1=sliderValue.getValue()
-	
-	#update slider values
-		
-	sliceSlid2=sliceSlid1
-	offsetSlid2=offsetSlid1
-	thickSlid2=thickSlid1
-	
-	excludedPixels=filter(lambda i: abs(pixels[i]) > slid1/10, xrange(len(pixels)))
-	pixelMap=array('i', [0]*len(pixels))
-	for i in excludedPixels:
-		pixelMap[i]=16674815
-	
-	#draw a preview of excluded pixels to divergence map 
-	excludedProcessor=ColorProcessor(imp.getWidth(), imp.getHeight(), pixelMap)
-	proi = ImageRoi(0, 0, excludedProcessor)
-	proi.setZeroTransparent(True)
-	proi.setOpacity(0.5)
-	overlay=Overlay()
-	overlay.add(proi)
-	imp.setOverlay(overlay)
-	imp.show()
-	imp.updateAndDraw()
-
-	#update slider values
-	slid2=slid1
-	sliceSlid2=sliceSlid1
 	width=imp.width
-	
 	for y in xrange(imp.height):
 		widths[y]=range(width)
 		heights[y]=	epidermisHeightsFull[y*width:(y+1)*(width)]	
-	roiYs= [x + offsetSlid1 for x in heights[sliceSlid1-1]] + [x + offsetSlid1 + thickSlid1 for x in reversed(heights[sliceSlid1-1])]
-	roiXs= [x for x in widths[sliceSlid1-1]] + [x for x in reversed(widths[sliceSlid1-1])]
-	# draw a preview of the segmented slice, of chosen thickness onto imp3 
-	proi2 = PolygonRoi(roiXs, roiYs, len(roiXs), Roi.POLYGON) 
-	proi2.setPosition(sliceSlid1)
-	proi2.setStrokeColor(Color.magenta)
-
-	proi3 = PolygonRoi(xrange(width), heights[sliceSlid1-1], width, Roi.POLYLINE)
-	proi3.setPosition(sliceSlid1)
-	proi3.setStrokeColor(Color.green)
-	
- 	overlay2=Overlay()
- 	overlay2.add(proi2)
- 	overlay2.add(proi3)
- 	imp3.setOverlay(overlay2)
- 	imp3.show()
-	imp3.updateAndDraw()
-	imp3.setOverlay(overlay2)
-	
-	while ((not gd.wasCanceled()) and not (gd.wasOKed())):
-		sliders=gd.getSliders()
-		sliderSlice=sliders.get(0)
-		sliderOffset=sliders.get(1)
-		sliderThick=sliders.get(2)
-		sliderValue=sliders.get(3)
-	
-		sliceSlid1=sliderSlice.getValue()
-		offsetSlid1=sliderOffset.getValue()
-		thickSlid1=sliderThick.getValue()
+
+	#slider values of the last drawn divergence map and slice previews
+	drawnValue=[None]
+	drawnSlice=[None, None, None]
+
+	def drawExcluded(slid1):
+		#draw a preview of excluded pixels to divergence map 
+		excludedProcessor=ColorProcessor(imp.getWidth(), imp.getHeight())
+		excludedProcessor.setColor(Color(0xFE6FFF))
+		excludedProcessor.fill(divergenceMask(pixels, imp.getWidth(), imp.getHeight(), slid1/10.0))
+		proi = ImageRoi(0, 0, excludedProcessor)
+		proi.setZeroTransparent(True)
+		proi.setOpacity(0.5)
+		overlay=Overlay()
+		overlay.add(proi)
+		imp.setOverlay(overlay)
+		imp.show()
+		imp.updateAndDraw()
+
+	def drawSlice(sliceSlid1, offsetSlid1, thickSlid1):
+		roiYs= [x + offsetSlid1 for x in heights[sliceSlid1-1]] + [x + offsetSlid1 + thickSlid1 for x in reversed(heights[sliceSlid1-1])]
+		roiXs= [x for x in widths[sliceSlid1-1]] + [x for x in reversed(widths[sliceSlid1-1])]
+		# draw a preview of the segmented slice, of chosen thickness onto imp3 
+		proi2 = PolygonRoi(roiXs, roiYs, len(roiXs), Roi.POLYGON) 
+		proi2.setPosition(sliceSlid1)
+		proi2.setStrokeColor(Color.magenta)
+
+		proi3 = PolygonRoi(xrange(width), heights[sliceSlid1-1], width, Roi.POLYLINE)
+		proi3.setPosition(sliceSlid1)
+		proi3.setStrokeColor(Color.green)
+		
+		overlay2=Overlay()
+		overlay2.add(proi2)
+		overlay2.add(proi3)
+		imp3.setOverlay(overlay2)
+		imp3.setSlice(sliceSlid1)
+		imp3.show()
+		imp3.updateAndDraw()
+
+	def preview(current):
 		slid1=sliderValue.getValue()
-		#If slider has changed, update preview	
-		if (slid2!=slid1):
-			excludedPixels=filter(lambda i: abs(pixels[i]) > slid1/10, xrange(len(pixels)))
-			pixelMap=array('i', [0]*len(pixels))
-			for i in excludedPixels:
-				pixelMap[i]=16674815
-			excludedProcessor=ColorProcessor(imp.getWidth(), imp.getHeight(), pixelMap)
-			proi = ImageRoi(0, 0, excludedProcessor)
-			proi.setZeroTransparent(True)
-			proi.setOpacity(0.5)
-			overlay=Overlay()
-			overlay.add(proi)
-			imp.setOverlay(overlay)
-			imp.show()
-			imp.updateAndDraw()
-			slid2=slid1
-			
-			IJ.selectWindow(imp.getTitle());
-			Thread.sleep(50)
-			continue
-		#If slider has changed, update preview
-		if (slid2!=slid1 or sliceSlid2!=sliceSlid1 or offsetSlid2!=offsetSlid1 or thickSlid2!=thickSlid1):
-		 	imp3.setSlice(sliceSlid1)
-		 	sliceSlid2=sliceSlid1
-			offsetSlid2=offsetSlid1
-			thickSlid2=thickSlid1
-			IJ.selectWindow(imp3.getTitle());
-			
-			proi2Ys= [x + offsetSlid1 for x in heights[sliceSlid1-1]] + [x + offsetSlid1 + thickSlid1 for x in reversed(heights[sliceSlid1-1])]
-			proi2Xs= [x for x in widths[sliceSlid1-1]] + [x for x in reversed(widths[sliceSlid1-1])]
-			
-			# draw create a new ROI and draw to the mask image image
-			proi2 = PolygonRoi(proi2Xs, proi2Ys, len(proi2Xs), Roi.POLYGON) 
-			proi2.setPosition(sliceSlid1)
-			proi2.setStrokeColor(Color.magenta)
-
-			proi3 = PolygonRoi(xrange(width), heights[sliceSlid1-1], width, Roi.POLYLINE)
-			proi3.setPosition(sliceSlid1)
-			proi3.setStrokeColor(Color.green)
-			
-		 	overlay2=Overlay()
-		 	overlay2.add(proi2)
-		 	overlay2.add(proi3)
-		 	imp3.setOverlay(overlay2)
-		 	imp3.show()
-			imp3.updateAndDraw()
-		 	Thread.sleep(50)
-		 	
-		 	continue
+		#only redraw the preview whose sliders have moved
+		if drawnValue[0]!=slid1 and current():
+			drawExcluded(slid1)
+			drawnValue[0]=slid1
+		sliceValues=[sliderSlice.getValue(), sliderOffset.getValue(), sliderThick.getValue()]
+		if drawnSlice!=sliceValues and current():
+			drawSlice(*sliceValues)
+			drawnSlice[:]=sliceValues
+
+	previewDialog(gd, preview)
 	
 	displaySlice = gd.getNextNumber()
 	erode = gd.getNextBoolean()
 	depthOffset = gd.getNextNumber()
-	xzOffset = gd.getNextNumber()
 	stackThickness = gd.getNextNumber()
-	xzThickness = gd.getNextNumber()
 	gaussian = gd.getNextBoolean()
 	hdRemoval = gd.getNextBoolean()
 	heightDiffMax = gd.getNextNumber()
+	holeFill = gd.getNextChoice()
 	if gaussian == 1:
 		gaussian = 10.0
 	else:
@@ -619,7 +1149,7 @@ def getOptions3(imp, pixels, imp3, epidermisHeightsFull):
 		oked=1
 	else:
 		oked=0	
-	return erode, depthOffset, stackThickness, canceled, hdRemoval, heightDiffMax, gaussian, xzOffset, xzThickness, oked
+	return erode, depthOffset, stackThickness, canceled, hdRemoval, heightDiffMax, gaussian, oked, holeFill
 
 def finalDialog():
 	gd = NonBlockingGenericDialog("EZ Peeler - Image check")
@@ -636,6 +1166,7 @@ def finalDialog():
 	gd.addCheckbox("Keep time series z projection?", True)
 	gd.addCheckbox("Keep time series heightmap?", False)
 	gd.addCheckbox("Keep time series areamap?", False)
+	gd.addCheckbox("Stream time series results to disk? (for long series that do not fit in memory)", False)
 	gd.showDialog()
 
 	keepPrev = gd.getNextBoolean()
@@ -645,6 +1176,7 @@ def finalDialog():
 	keepZP = gd.getNextBoolean()
 	keepHM = gd.getNextBoolean()
 	keepAM = gd.getNextBoolean()
+	streamToDisk = gd.getNextBoolean()
 	if gd.wasCanceled():
 		canceled = 1
 		print "canceled dialog 4"
@@ -654,33 +1186,14 @@ def finalDialog():
 		oked=1
 	else:
 		oked=0
-	return canceled, timeseries, oked, keep3D, keepZP, keepHM, keepAM, keepPrev	
+	return canceled, timeseries, oked, keep3D, keepZP, keepHM, keepAM, keepPrev, streamToDisk
 	
-def findEpidermis(pixels, width, height, threshold, interpolation, interpolRes, topSlice,andOp):
-	""" iterates through the image, finding the first pixel above the threshold value, then performs user specified error correction"""
-
-	#Create a list of initial values 1 larger than the image height
-	
-	epidermisHeights=[height+1]*width	  
-	
-	# Go through pixels, looking for first pixel with a value greater than threshold in the y, placing y coord in a list
+def epidermisVertices(epidermisHeights, width, height):
+	"""turns the surface heights of one slice into non redundant ROI X and Y positions, dropping columns where nothing was found"""
 
 	epidermisYs = []
 	epidermisXs = []
 
-	
-	for x in xrange(width):
-		for y in xrange(topSlice, height):
-			pixel= width*y+x
-
-			#after finding the first pixel above the threshold value, add the y coord to the list
-			if pixels[pixel]& andOp > threshold:
-			
-				epidermisHeights[x] = y
-				#break from looping the y when 1st threshold pixel is found is met -> increases speed drastically! Otherwise need an if statement every loop...
-				break
-
-
 	#Add non-redundant coords to two new lists. Points where no threshold value was met are excluded automatically, to be filled by interpolation later
 	#(first and last coords are fixed + therefore added manually, the rest are added non-redundantly in the loop)
 
@@ -707,42 +1220,455 @@ def findEpidermis(pixels, width, height, threshold, interpolation, interpolRes,
 	#return ROI X and Y positions and an array of pure height data for heightmap
 	return epidermisXs, epidermisYs
 
-def firstStage(channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU):
-		#extract the channel you want to base the peeler on
-		imp2 = extractChannel(imp1, int(channels)+1, frame, andOp)
-		
-		#run the chosen filter
-		src = smoothFilter(imp2, filtertype, int(smoothsize))
-		dst = clij2.create([src.getWidth(), src.getDepth(), src.getHeight()], src.getNativeType())
-	
-		#reslice the extracted channel and show resultant
-		clij2.resliceTop(src, dst)
-		src.close()
-		imp3 = clij2.pull(dst)
-		
-		dst.close()
-		ip = imp3.getProcessor()
-		
-		width = ip.getWidth()
-		height= ip.getHeight()
-	
-		# Redraw based on max pixel value
-		findEdge(imp3, sobeltype)
-		stats =StackStatistics(imp3) 
-		frame1Mean=stats.mean
+class ThresholdIndex:
+	"""threshold query index of a resliced stack. Holds the running maximum down Z of every column from topSlice, which only grows with Z,
+	so the first voxel above any threshold is found by binary search instead of rescanning the column"""
+
+	def __init__(self, imp, topSlice, andOp):
+		self.imp = imp
+		self.topSlice = int(topSlice)
+		self.andOp = andOp
+		self.depth = imp.getHeight()
+
+		#reslice back to XY, so each Z plane holds one voxel of every column
+		slicer = Slicer()
+		slicer.setNointerpolate(True)
+		planes = slicer.reslice(ImagePlus("Surface index", imp.getImageStack())).getImageStack()
+		self.width = planes.getWidth()
+
+		#fold each plane into the running maximum in place, keeping the range of every plane
+		self.runningMax = []
+		self.planeMin = []
+		self.planeMax = []
+		previous = None
+		for z in xrange(self.topSlice, self.depth):
+			ip = planes.getProcessor(z+1)
+			if previous is not None:
+				ip.copyBits(previous, 0, 0, Blitter.MAX)
+			stats = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX, None)
+			self.runningMax.append(ip)
+			self.planeMin.append(stats.min)
+			self.planeMax.append(stats.max)
+			previous = ip
+		self.pixels = [plane.getPixels() for plane in self.runningMax]
+
+	def heightmap(self, threshold):
+		"""the first Z above the threshold for every column, depth+1 where there is none"""
+		notFound = self.depth+1
+		heightMap = FloatProcessor(self.width, self.imp.getNSlices())
+		if not self.runningMax:
+			heightMap.set(notFound)
+			return heightMap
+
+		#integer voxels are above the threshold when they are at least floor(threshold)+1
+		level = math.floor(threshold)
+
+		#planes at or below the threshold in every column push every column down one, planes above it everywhere change nothing,
+		#so only the band between them needs to be looked at
+		start = bisect.bisect_right(self.planeMax, level)
+		stop = bisect.bisect_right(self.planeMin, level)
+		heightMap.set(self.topSlice+start)
+		for k in xrange(start, stop):
+			#1 where the running maximum is still at or below the threshold
+			plane = self.runningMax[k].convertToFloat()
+			plane.subtract(level)
+			plane.min(0)
+			plane.max(1)
+			plane.multiply(-1)
+			plane.add(1)
+			heightMap.copyBits(plane, 0, 0, Blitter.ADD)
+
+		#columns that never went above the threshold have counted every plane, move them to notFound
+		missing = heightMap.duplicate()
+		missing.subtract(self.depth-1)
+		missing.min(0)
+		missing.max(1)
+		heightMap.copyBits(missing, 0, 0, Blitter.ADD)
+		return heightMap
+
+	def sliceHeights(self, sliceIndex, threshold, height):
+		"""the first Z above the threshold for each column of one resliced slice, searching Z up to height and returning height+1 where there is none"""
+		epidermisHeights = [height+1]*self.width
+		searchable = min(height, self.depth) - self.topSlice
+		offset = sliceIndex*self.width
+		for x in xrange(self.width):
+			lo = 0
+			hi = searchable
+			while lo < hi:
+				mid = (lo+hi)//2
+				if self.pixels[mid][offset+x] & self.andOp > threshold:
+					hi = mid
+				else:
+					lo = mid+1
+			if lo < searchable:
+				epidermisHeights[x] = self.topSlice+lo
+		return epidermisHeights
+
+def searchStrip(stack, y0, y1, z0, z1, bandTop, stripHeights, threshold, notFound):
+	"""sets stripHeights to the first Z from z0 to z1 above the threshold for the columns of resliced slices y0 to y1 that are still notFound,
+	only looking at or below bandTop"""
+	width = stack.getWidth()
+	plane = stack.getProcessor(1).createProcessor(width, y1-y0)
+	pixels = plane.getPixels()
+	if isinstance(plane, FloatProcessor):
+		lower = Math.nextUp(float(threshold))
+	else:
+		lower = math.floor(threshold)+1
+	for z in xrange(z0, z1):
+		#gather row z of every slice into one XY plane
+		for row in xrange(y1-y0):
+			System.arraycopy(stack.getPixels(y0+row+1), z*width, pixels, row*width, width)
+		plane.setThreshold(lower, plane.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+		hits = plane.createMask()
+		bandTop.setThreshold(-Float.MAX_VALUE, z, ImageProcessor.NO_LUT_UPDATE)
+		hits.copyBits(bandTop.createMask(), 0, 0, Blitter.AND)
+		stripHeights.setThreshold(notFound, notFound, ImageProcessor.NO_LUT_UPDATE)
+		hits.copyBits(stripHeights.createMask(), 0, 0, Blitter.AND)
+		stripHeights.setValue(z)
+		stripHeights.fill(hits)
+
+def bandHeightmap(imp3, threshold, bandTop, bandDepth, strip, fallbackTop=None, fallbackMask=None):
+	"""the first Z above the threshold for every column of a resliced stack, as ThresholdIndex.heightmap returns it,
+	searching each strip of rows from bandTop down bandDepth slices. Columns not found in the band (and set in fallbackMask, if given)
+	are searched to the bottom of the stack, from fallbackTop if given or else from the end of the band.
+	Returns the heightmap and the number of columns that needed that fallback"""
+	width = imp3.getWidth()
+	depth = imp3.getHeight()
+	rows = imp3.getStackSize()
+	notFound = depth+1
+	stack = imp3.getStack()
+	heights = FloatProcessor(width, rows)
+	fallbacks = 0
+	for y0 in xrange(0, rows, strip):
+		y1 = min(y0+strip, rows)
+		bandTop.setRoi(0, y0, width, y1-y0)
+		stripTop = bandTop.crop()
+		topStats = ImageStatistics.getStatistics(stripTop, Measurements.MIN_MAX, None)
+		bandEnd = min(int(topStats.max)+bandDepth, depth)
+		stripHeights = FloatProcessor(width, y1-y0)
+		stripHeights.set(notFound)
+		searchStrip(stack, y0, y1, int(topStats.min), bandEnd, stripTop, stripHeights, threshold, notFound)
+
+		stripHeights.setThreshold(notFound, notFound, ImageProcessor.NO_LUT_UPDATE)
+		missed = stripHeights.createMask()
+		if fallbackMask is not None:
+			fallbackMask.setRoi(0, y0, width, y1-y0)
+			missed.copyBits(fallbackMask.crop(), 0, 0, Blitter.AND)
+		missedColumns = int(round(ImageStatistics.getStatistics(missed, Measurements.MEAN, None).mean*missed.getPixelCount()/255))
+		if missedColumns > 0:
+			if fallbackTop is None:
+				fallbackStart = bandEnd
+			else:
+				fallbackTop.setRoi(0, y0, width, y1-y0)
+				stripTop = fallbackTop.crop()
+				fallbackStart = int(ImageStatistics.getStatistics(stripTop, Measurements.MIN_MAX, None).min)
+			if fallbackStart < depth:
+				fallbacks += missedColumns
+				searchStrip(stack, y0, y1, fallbackStart, depth, stripTop, stripHeights, threshold, notFound)
+		stripHeights.resetThreshold()
+		heights.insert(stripHeights, 0, y0)
+	bandTop.resetRoi()
+	return heights, fallbacks
+
+def pyramidHeightmap(imp3, threshold, topSlice, andOp, factor, band):
+	"""the first Z above the threshold for every column of a resliced stack, found coarse to fine.
+	The surface is first found on the stack max binned by factor, which can only place it too high, then each strip of columns is searched
+	from there down factor+band slices. Columns the coarse search found but the band did not are searched to the bottom, so the result
+	is the same as a full search. Returns the heightmap and the number of columns that needed that fallback"""
+	width = imp3.getWidth()
+	rows = imp3.getStackSize()
+	topSlice = int(topSlice)
+
+	#coarse surface, in binned slices, with the columns that were not found moved to the unbinned bottom slices
+	coarse = Binner().shrink(imp3, factor, factor, factor, Binner.MAX)
+	coarseDepth = coarse.getHeight()
+	coarseHeights = ThresholdIndex(coarse, topSlice/factor, andOp).heightmap(threshold)
+	coarseHeights.setThreshold(-1, coarseDepth, ImageProcessor.NO_LUT_UPDATE)
+	coarseFound = ByteProcessor(width, rows)
+	coarseFound.setValue(255)
+	coarseFound.fill()
+	coarseFound.insert(nearestUpsample(coarseHeights.createMask(), factor), 0, 0)
+	coarseHeights.max(coarseDepth)
+	coarseHeights.multiply(factor)
+	coarse.close()
+
+	#full resolution top of the search band, columns outside the binned area are searched from topSlice
+	bandTop = FloatProcessor(width, rows)
+	bandTop.set(topSlice)
+	bandTop.insert(nearestUpsample(coarseHeights, factor), 0, 0)
+	bandTop.min(topSlice)
+	return bandHeightmap(imp3, threshold, bandTop, factor+band, factor, None, coarseFound)
+
+def temporalHeightmap(imp3, threshold, topSlice, seed, band):
+	"""the first Z above the threshold for every column of a resliced stack, searched only within band slices of the heightmap of an earlier frame.
+	Columns with nothing above the threshold in the band are searched from topSlice, so a surface found in the band can be missed only if
+	there is another one above it. Returns the heightmap and the number of columns that needed the full search"""
+	topSlice = int(topSlice)
+	bandTop = seed.duplicate()
+	bandTop.subtract(band)
+	bandTop.min(topSlice)
+	fullTop = FloatProcessor(imp3.getWidth(), imp3.getStackSize())
+	fullTop.set(topSlice)
+	return bandHeightmap(imp3, threshold, bandTop, 2*band+1, temporalStrip, fullTop)
+
+def nearestUpsample(ip, factor):
+	"""scales a processor up by a whole factor, repeating every pixel in a factor by factor block"""
+	ip.setInterpolationMethod(ImageProcessor.NONE)
+	return ip.resize(ip.getWidth()*factor, ip.getHeight()*factor)
+
+def thresholdIndex(imp, topSlice, andOp):
+	"""returns the threshold index of a resliced stack, only building it again when the stack or topSlice changes"""
+	global cachedIndex
+	index = cachedIndex
+	if index is None or index.imp is not imp or index.topSlice != int(topSlice):
+		index = ThresholdIndex(imp, topSlice, andOp)
+		cachedIndex = index
+	return index
+
+class StageCache:
+	"""keeps the results of firstStage by image, channel, frame, filter settings and where the surface is searched. Once the cached stacks take more than maxBytes,
+	the least recently used results are closed"""
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.entries = OrderedDict()
+		self.bytesResident = 0
+
+	def key(self, imp, channels, frame, filtertype, smoothsize, sobeltype, andOp, deviceSurface):
+		return imp.getID(), int(channels), int(frame), str(filtertype), int(smoothsize), str(sobeltype), targetBitDepth(andOp), bool(deviceSurface)
+
+	def get(self, key):
+		"""the cached firstStage result, or None"""
+		result = self.entries.pop(key, None)
+		if result is not None:
+			#move the key to the most recently used end
+			self.entries[key] = result
+		return result
+
+	def put(self, key, result):
+		self.entries[key] = result
+		self.bytesResident += self.sizeOf(result)
+		#the newest result is kept even if it is larger than maxBytes, it is in use
+		while self.bytesResident > self.maxBytes and len(self.entries) > 1:
+			self.evict()
+
+	def holds(self, imp):
+		return any(imp is result[0] or imp is result[1] for result in self.entries.values())
+
+	def sizeOf(self, result):
+		#counts channel stacks in full even when they share the planes of the image, so the bound is never exceeded
+		return sum(imp.getSizeInBytes() for imp in result[:2] if imp is not None)
+
+	def evict(self):
+		key, result = self.entries.popitem(last=False)
+		self.bytesResident -= self.sizeOf(result)
+		for imp in result[:2]:
+			if imp is not None:
+				imp.close()
+
+	def clear(self):
+		while self.entries:
+			self.evict()
+
+def firstStage(channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU, deviceSurface):
+		#extract the channel you want to base the peeler on, on the GPU its planes are pushed as they are and converted there
+		if gpuBackend and imp1.getBitDepth() in [8, 16]:
+			imp2 = channelView(imp1, int(channels)+1, frame)
+		else:
+			imp2 = extractChannel(imp1, int(channels)+1, frame, andOp)
 		
-		IJ.setMinAndMax(imp3, 0, stats.max)
-		IJ.run(imp3, "Grays", "stack")
-	
-		imp3.setTitle("Resliced channnel "+ str(channels)+ ", frame "+ str(frame))
-		imp3.show()
+		#run the chosen filter, stacks too large for the GPU are filtered and resliced in tiles
+		src = None
+		edgesFound = False
+		stats = None
+		if fitsOnDevice(3*imp2.getWidth()*imp2.getHeight()*imp2.getStackSize()*imp2.getBitDepth()/8):
+			src = smoothFilter(imp2, filtertype, int(smoothsize), targetBitDepth(andOp))
+
+		if src is None:
+			imp2 = extractChannel(imp1, int(channels)+1, frame, andOp)
+			imp3 = tiledFilterReslice(imp2, filtertype, int(smoothsize))
+		else:
+			#without an XZ edge filter the surface can be found on the GPU, so keep the filtered stack there and only reslice it for the preview
+			if deviceSurface and gpuBackend and sobeltype == "none":
+				stats, defaultThreshold = deviceStatistics(src, andOp)
+				return imp2, None, src.getWidth(), src.getDepth(), stats, None, defaultThreshold, src
+
+			#reslice the extracted channel and show resultant, convolution edge filters are run before it is pulled
+			resliced = deviceReslice(src, sobeltype)
+			bufferPool.release(src)
+			edgesFound = sobeltype in edgeKernels
+			#on the GPU the statistics come from a histogram of the buffer before it is pulled, unless Find Edges is still to run on CPU
+			if gpuBackend and sobeltype != "2D Sobel":
+				stats, defaultThreshold = deviceStatistics(resliced, andOp)
+			imp3 = clij2.pull(resliced)
+			bufferPool.release(resliced)
+		width = imp3.getWidth()
+		height= imp3.getHeight()
+	
+		# Redraw based on max pixel value, on CPU the histogram is taken from each slice as it is filtered
+		if stats is None:
+			histogram = StackHistogram()
+			if edgesFound:
+				findEdge(imp3, "none", histogram)
+			else:
+				findEdge(imp3, sobeltype, histogram)
+			stats, defaultThreshold = histogram.statistics()
+		elif not edgesFound:
+			findEdge(imp3, sobeltype)
 		
-		IJ.setAutoThreshold(imp3, "Otsu dark stack")
-		defaultThreshold=imp3.getProcessor().getMinThreshold()
-		IJ.resetThreshold(imp3)
+		displayResliced(imp3, channels, frame, stats.max)
 		stack = imp3.getStack()
-		return imp2, imp3, width, height, stats, stack, defaultThreshold
-def secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice, useOtsu, defaultThreshold):
+		return imp2, imp3, width, height, stats, stack, defaultThreshold, None
+
+def deviceReslice(src, sobeltype="none"):
+	"""reslices a filtered GPU stack to XZ slices, running a convolution edge filter on them if one is given"""
+	dst = bufferPool.lease([src.getWidth(), src.getDepth(), src.getHeight()], src.getNativeType())
+	clij2.resliceTop(src, dst)
+	if sobeltype in edgeKernels:
+		edges = deviceEdge(dst, sobeltype)
+		bufferPool.release(dst)
+		dst = edges
+	return dst
+
+def reslicedView(src, sobeltype="none"):
+	"""reslices a filtered GPU stack to XZ slices and pulls it back as an imagePlus"""
+	dst = deviceReslice(src, sobeltype)
+	imp3 = clij2.pull(dst)
+	bufferPool.release(dst)
+	return imp3
+
+def displayResliced(imp3, channels, frame, maxPixel):
+	"""shows the resliced channel used for the segmentation preview"""
+	IJ.setMinAndMax(imp3, 0, maxPixel)
+	IJ.run(imp3, "Grays", "stack")
+
+	imp3.setTitle("Resliced channnel "+ str(channels)+ ", frame "+ str(frame))
+	if not headless:
+		imp3.show()
+
+def autoThreshold(histogram, histMin, histMax):
+	"""the lower bound of the dark background autoThresholdMethod threshold of a 256 bin histogram from histMin to histMax,
+	the level above the threshold bin scaled like ImageJ's stack thresholds"""
+	level = AutoThresholder().getThreshold(AutoThresholder.Method.valueOf(autoThresholdMethod), array('i', histogram))
+	return histMin + (level+1)*(histMax-histMin)/255.0
+
+class StackHistogram:
+	"""histogram of an 8 or 16 bit stack, added to slice by slice from any thread, with a bin for every grey value.
+	Gives the statistics of StackStatistics and the threshold of setAutoThreshold on the stack without another pass over it.
+	Slices are summed in a float processor while that is exact, below 2^24 voxels, and moved into python ints before it can round"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = None
+		self.partial = None
+		self.partialVoxels = 0
+
+	def add(self, ip):
+		counts = ip.getHistogram()
+		counts = FloatProcessor(len(counts), 1, counts)
+		with self.lock:
+			if self.partialVoxels + ip.getPixelCount() >= 1 << 24:
+				self.flush()
+			if self.partial is None:
+				self.partial = counts
+			else:
+				self.partial.copyBits(counts, 0, 0, Blitter.ADD)
+			self.partialVoxels += ip.getPixelCount()
+
+	def flush(self):
+		if self.partial is None:
+			return
+		partial = self.partial.getPixels()
+		if self.counts is None:
+			self.counts = [0]*len(partial)
+		for i in xrange(len(partial)):
+			if partial[i]:
+				self.counts[i] += int(partial[i])
+		self.partial = None
+		self.partialVoxels = 0
+
+	def statistics(self):
+		"""min, max and mean as an ImageStatistics, and the default threshold"""
+		with self.lock:
+			self.flush()
+		return histogramStatistics(self.counts, 0, len(self.counts) == 256)
+
+def histogramStatistics(counts, first, eightBit):
+	"""min, max and mean as an ImageStatistics, and the default threshold, from the number of voxels of every grey value from first on.
+	Like StackStatistics, 8-bit stacks get a bin per grey value and 16-bit stacks 256 bins from min to max"""
+	levels = [i for i in xrange(len(counts)) if counts[i] > 0]
+	stats = ImageStatistics()
+	stats.min = float(first+levels[0])
+	stats.max = float(first+levels[-1])
+	voxels = sum(counts[i] for i in levels)
+	stats.pixelCount = voxels
+	stats.mean = float(sum((first+i)*counts[i] for i in levels))/voxels
+
+	histogram = [0]*256
+	if eightBit:
+		histMin, histMax = 0.0, 255.0
+		for i in levels:
+			histogram[first+i] += counts[i]
+	else:
+		histMin, histMax = stats.min, stats.max
+		binSize = (histMax-histMin)/256.0
+		for i in levels:
+			if binSize > 0:
+				histogram[min(int((first+i-histMin)/binSize), 255)] += counts[i]
+			else:
+				histogram[0] += counts[i]
+	stats.histogram = array('i', histogram)
+	return stats, autoThreshold(histogram, histMin, histMax)
+
+def deviceStatistics(src, andOp):
+	"""min, max, mean and dark auto threshold of a GPU stack, pulling back only its histogram. CLIJ2 counts every grey value
+	from min to max in a bin of its own, whatever its bin edges, and the bins are then merged like StackHistogram does"""
+	first = int(clij2.getMinimumOfAllPixels(src))
+	last = int(clij2.getMaximumOfAllPixels(src))
+	nBins = last-first+1
+	if nBins == 1:
+		return histogramStatistics([src.getWidth()*src.getHeight()*src.getDepth()], first, andOp == 0xFF)
+
+	#CLIJ2 fills a partial histogram for every row before summing them, too large for wide 16-bit ranges on small devices
+	if not fitsOnDevice(4*nBins*(src.getHeight()+1)):
+		stack = clij2.pull(src).getStack()
+		histogram = StackHistogram()
+		parallelSlices(stack.getSize(), lambda i: histogram.add(stack.getProcessor(i)))
+		return histogram.statistics()
+	histBuffer = bufferPool.lease([nBins, 1, 1], NativeTypeEnum.Float)
+	clij2.histogram(src, histBuffer, nBins, first, last, False)
+	counts = map(int, clij2.pull(histBuffer).getProcessor().getPixels())
+	bufferPool.release(histBuffer)
+	return histogramStatistics(counts, first, andOp == 0xFF)
+
+def deviceHeightmap(src, threshold, topSlice, height):
+	"""finds the first voxel above the threshold in every column of a GPU stack, pulling back only the 2D heightmap"""
+	notFound = height+1
+
+	#1 where the voxel is above the threshold, ignoring slices above topSlice
+	binary = bufferPool.leaseLike(src)
+	clij2.greaterConstant(src, binary, threshold)
+	for z in xrange(int(topSlice)):
+		clij2.setPlane(binary, z, 0)
+
+	#the arg maximum is the first 1 down each column, or 0 when the column has no 1 in it
+	found = bufferPool.lease([src.getWidth(), src.getHeight()], NativeTypeEnum.Float)
+	firstZ = bufferPool.leaseLike(found)
+	clij2.argMaximumZProjection(binary, found, firstZ)
+	bufferPool.release(binary)
+
+	#move the columns where nothing was found to notFound
+	missing = bufferPool.leaseLike(found)
+	clij2.multiplyImageAndScalar(found, missing, -notFound)
+	clij2.addImageAndScalar(missing, found, notFound)
+	clij2.addImages(firstZ, found, missing)
+
+	#pull result from GPU
+	heightMap = clij2.pull(missing).getProcessor()
+	bufferPool.release(found)
+	bufferPool.release(firstZ)
+	bufferPool.release(missing)
+	return heightMap
+
+def secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice, useOtsu, defaultThreshold, imp3, surfaceBuffer, width, height, frame, pyramid=1, seed=None):
 	if useOtsu==1:
 			minThreshold=defaultThreshold
 	
@@ -754,11 +1680,30 @@ def secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice,
 	epidermisHeightsFull = []
 	xvertices= [range(width)]
 	
-	for sliceN in xrange(imp3.getNSlices()):
+	#find the top of the epidermis for every column in the stack at once
+	if surfaceBuffer is not None:
+		gpuLock.lock()
+		try:
+			surfacePixels = deviceHeightmap(surfaceBuffer, minThreshold, topSlice, height).getPixels()
+		finally:
+			gpuLock.unlock()
+	elif seed is not None:
+		surface, fallbacks = temporalHeightmap(imp3, minThreshold, topSlice, seed, temporalBand)
+		surfacePixels = surface.getPixels()
+		print "Frame %s: %.1f%% of columns searched past the band around the previous frame" % (str(frame), 100.0*fallbacks/len(surfacePixels))
+	elif pyramid > 1:
+		surface, fallbacks = pyramidHeightmap(imp3, minThreshold, topSlice, andOp, int(pyramid), pyramidBand)
+		surfacePixels = surface.getPixels()
+		print "Frame %s: %.1f%% of columns searched past the coarse surface band" % (str(frame), 100.0*fallbacks/len(surfacePixels))
+	else:
+		surfacePixels = thresholdIndex(imp3, topSlice, andOp).heightmap(minThreshold).getPixels()
+	
+	for sliceN in xrange(len(surfacePixels)/width):
 
 
 		#get x + y positions of the top of the epidermis for this slice
-		widths[sliceN+1], heights[sliceN+1] = findEpidermis(stack.getPixels(sliceN+1), width, height, minThreshold, interpolation, interpolRes, topSlice, andOp)
+		epidermisHeights = map(int, surfacePixels[sliceN*width:(sliceN+1)*width])
+		widths[sliceN+1], heights[sliceN+1] = epidermisVertices(epidermisHeights, width, height)
 
 		
 		#add to ROI and editor
@@ -795,7 +1740,8 @@ def secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice,
 	heightMapArray = array( "f", epidermisHeightsFull)
 	fp= FloatProcessor(width, len(heightMapArray)/width, epidermisHeightsFull, None)
 	heightsImp= ImagePlus("Uncalibrated Heightmap", fp)
-	heightsImp.show()
+	if not headless:
+		heightsImp.show()
 	
 	fp2= FloatProcessor(width, len(heightMapArray)/width, epidermisHeightsFull, None)
 	
@@ -816,24 +1762,91 @@ def secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice,
 	return heights, widths, epidermisHeightsFull, xvertices, heightMapArray, fp, heightsImp, blurredHeights, imgBlur, imgHeights, sub, subIP, subPixels, impSub
 
 
-def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian,xzOffset, xzThickness):
-
-	widths={}
-	heights={}
-	if hdRemoval:
-		
+def pushPull(values, valid):
+	"""normalized convolution on an image pyramid. Weighted means are pushed down until a level has no gaps,
+	then pulled back up into the gaps of each finer level. Returns None if there is no valid pixel"""
+	sums = values.duplicate()
+	sums.copyBits(valid, 0, 0, Blitter.MULTIPLY)
+	levels = [(sums, valid)]
+	while ImageStatistics.getStatistics(levels[-1][1], Measurements.MIN_MAX, None).min <= 0:
+		sums, weights = levels[-1]
+		if sums.getWidth() == 1 and sums.getHeight() == 1:
+			return None
+		levelWidth = (sums.getWidth()+1)/2
+		levelHeight = (sums.getHeight()+1)/2
+		levels.append((sums.resize(levelWidth, levelHeight, True), weights.resize(levelWidth, levelHeight, True)))
+	sums, weights = levels[-1]
+	filled = sums.duplicate()
+	filled.copyBits(weights, 0, 0, Blitter.DIVIDE)
+	for sums, weights in reversed(levels[:-1]):
+		#blend the coarser fill in by the share of each pixel that is missing
+		filled.setInterpolationMethod(ImageProcessor.BILINEAR)
+		filled = filled.resize(sums.getWidth(), sums.getHeight())
+		missing = weights.duplicate()
+		missing.multiply(-1)
+		missing.add(1)
+		filled.copyBits(missing, 0, 0, Blitter.MULTIPLY)
+		filled.copyBits(sums, 0, 0, Blitter.ADD)
+	return filled
+
+def fillHoles(heights, holes, holeRoi):
+	"""inpaints the pixels set to 255 in the byteProcessor holes from their valid surroundings.
+	Each part of holeRoi is solved in its bounding box padded by its own size, so the cost follows the holes, not the image"""
+	filled = heights.duplicate()
+	if holeRoi is None:
+		return filled
+	if isinstance(holeRoi, ShapeRoi):
+		parts = holeRoi.getRois()
+	else:
+		parts = [holeRoi]
+	valid = holes.convertToFloat()
+	valid.multiply(-1.0/255)
+	valid.add(1)
+	for part in parts:
+		bounds = part.getBounds()
+		pad = max(bounds.width, bounds.height)
+		x0 = max(bounds.x-pad, 0)
+		y0 = max(bounds.y-pad, 0)
+		x1 = min(bounds.x+bounds.width+pad, heights.getWidth())
+		y1 = min(bounds.y+bounds.height+pad, heights.getHeight())
+		heights.setRoi(x0, y0, x1-x0, y1-y0)
+		valid.setRoi(x0, y0, x1-x0, y1-y0)
+		patch = pushPull(heights.crop(), valid.crop())
+		#valid pixels come back unchanged, so the whole patch can be written
+		if patch is not None:
+			filled.insert(patch, x0, y0)
+	heights.resetRoi()
+	return filled
+
+def bandTop(heightsFull, width, rows, depthOffset):
+	"""returns the heightmap shifted by depthOffset as a floatProcessor, the top of the peeled band"""
+	top = FloatProcessor(width, rows, array("f", heightsFull))
+	top.add(depthOffset)
+	return top
+
+def bandPlane(top, z, stackThickness, value):
+	"""returns the 8-bit mask of XY plane z (counted from 1), set to value where top <= z-1 < top+stackThickness"""
+	plane = ByteProcessor(top.getWidth(), top.getHeight())
+	if stackThickness > 0:
+		#z is inside the band where the top of the band lies in (z-stackThickness, z]
+		band = top.duplicate()
+		band.setThreshold(Math.nextUp(float(z-1-stackThickness)), z-1, ImageProcessor.NO_LUT_UPDATE)
+		plane.setValue(value)
+		plane.fill(band.createMask())
+	return plane
+
+def removeHoles(fp, subPixels, width, heightDiffMax, holeFill):
+	"""returns the heightmap pixels with the points that diverge from the smoothed surface by more than heightDiffMax filled in again"""
 	#Create a dict of lists, for each list, copy heights from heightimage, leaving out choords that exceed the threshold in the divergence map.
-		excludedPixels=filter(lambda i: abs(subPixels[i]) > heightDiffMax, xrange(len(subPixels)))
-		excludeMapArray=array('b', [0]*len(subPixels))
-		for i in excludedPixels:
-			excludeMapArray[i]=100
-		excludeP= ByteProcessor(width, len(subPixels)/width, excludeMapArray)
-		excludeP.erode()
-		excludeP.erode()
-		excludeP.setThreshold(90, 110, ImageProcessor.NO_LUT_UPDATE)
-		excludedImp=ImagePlus("exclusion map", excludeP)
-		excludeROI = ThresholdToSelection.run(excludedImp)
-		excludedImp.close()
+	excludeP= divergenceMask(subPixels, width, len(subPixels)/width, heightDiffMax)
+	excludeP.erode()
+	excludeP.erode()
+	excludeP.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+	excludedImp=ImagePlus("exclusion map", excludeP)
+	excludeROI = ThresholdToSelection.run(excludedImp)
+	if holeFill == "inpaint":
+		epidermisHeightsFull=fillHoles(fp, excludeP, excludeROI).getPixels()
+	else:
 		correctedHeightsImp = ImagePlus("corrected Heightmap", fp).duplicate()
 		correctedHeightsImp.setRoi(excludeROI)
 		
@@ -846,20 +1859,68 @@ def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, cancele
 		correctedHeightsP=correctedHeightsImp.getProcessor()
 		epidermisHeightsFull=correctedHeightsP.getPixels()
 		correctedHeightsImp.close()
-	for y in xrange(impSub.height):
+	excludedImp.close()
+	return epidermisHeightsFull
+
+def heightMask(heightsFull, width, rows, depth, depthOffset, stackThickness, value):
+	"""rasterizes the voxels with h+depthOffset <= z < h+depthOffset+stackThickness straight into an XY oriented 8-bit stack, set to value"""
+	top = bandTop(heightsFull, width, rows, depthOffset)
+	planes = [None]*depth
+	def rasterize(z):
+		planes[z-1] = bandPlane(top, z, stackThickness, value)
+	parallelSlices(depth, rasterize)
+	stack = ImageStack(width, rows)
+	for plane in planes:
+		stack.addSlice(None, plane)
+	return ImagePlus("Binary Stack", stack)
+
+def surfaceProjection(imp5, heightsFull, depthOffset, stackThickness, gaussian):
+	"""sums the voxels of every channel inside the peeled band straight from the frame, without building the mask or segmented stacks.
+	With the gaussian option each plane's mask is blurred like the render mask, so edge voxels are weighted the same way"""
+	width = imp5.getWidth()
+	rows = imp5.getHeight()
+	top = bandTop(heightsFull, width, rows, depthOffset)
+	stack = imp5.getStack()
+	sums = [None]*imp5.getNChannels()
+	def project(channel):
+		total = FloatProcessor(width, rows)
+		for z in xrange(1, imp5.getNSlices()+1):
+			weights = bandPlane(top, z, stackThickness, gaussian)
+			if gaussian == 10.0:
+				GaussianBlur().blurGaussian(weights, 1)
+			weights = weights.convertToFloat()
+			if gaussian == 10.0:
+				weights.multiply(0.1)
+			weights.copyBits(stack.getProcessor(imp5.getStackIndex(channel, z, 1)).convertToFloat(), 0, 0, Blitter.MULTIPLY)
+			total.copyBits(weights, 0, 0, Blitter.ADD)
+		sums[channel-1] = total
+	parallelSlices(imp5.getNChannels(), project)
+	projection = ImageStack(width, rows)
+	for total in sums:
+		projection.addSlice(None, total)
+	sumProjImp = ImagePlus("SUM_Segmented surface", projection)
+	sumProjImp.setDimensions(imp5.getNChannels(), 1, 1)
+	sumProjImp.setCalibration(imp5.getCalibration())
+	return sumProjImp
+
+def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian, fp, subPixels, width, height, imp1, frame, holeFill, keep3D=1):
+
+	widths={}
+	heights={}
+	if hdRemoval:
+		epidermisHeightsFull = removeHoles(fp, subPixels, width, heightDiffMax, holeFill)
+	for y in xrange(len(subPixels)/width):
 		widths[y]=range(width)
 		heights[y]=	epidermisHeightsFull[y*width:(y+1)*(width)]
 
 	
 
 
-	#create an image to draw the ROIs to
-	binaryMask = IJ.createImage("Binary Mask", "8-bit black", width, height,(len(heights)))
-	
-	stack2=binaryMask.getImageStack()
-	
 	#iterate through the ROI chords, and draw to the new image
 	if erode:
+		#create an image to draw the ROIs to
+		binaryMask = IJ.createImage("Binary Mask", "8-bit black", width, height,(len(heights)))
+		stack2=binaryMask.getImageStack()
 		for sliceN in range(len(heights)):
 			# make new ROIs, the size and thickness requested by the user	
 			roiYs= [x+1 for x in heights[sliceN]] +[height, height]
@@ -877,55 +1938,23 @@ def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, cancele
 		BS2 = ImagePlus("Binary Stack", stack2)
 		IJ.setMinAndMax(BS2, 0, 1)
 		
-		src2 = clij2.push(BS2)
-		BS2.close()	
-		dst2 = clij2.create(src2)
-
-		clij2.minimum3DSphere(src2, dst2, int(xzOffset),int(depthOffset),int(xzOffset))
-		clij2.minimum3DSphere(dst2, src2, int(xzThickness), int(stackThickness), int(xzThickness))
-
-		dst3=clij2.create(src2)
-
-		clij2.subtract(dst2, src2, dst3)
-
-		BS = clij2.pull(dst3)
-		#BS.show()
-		src2.close()
-		dst2.close()
-		dst3.close()
-	else:
-		for sliceN in range(len(heights)):
-			# make new ROIs, the size and thickness requested by the user	
-			roiYs= [x + depthOffset for x in heights[sliceN]] + [x + depthOffset + stackThickness for x in reversed(heights[sliceN])]
-			roiXs= [x for x in widths[sliceN]] + [x for x in reversed(widths[sliceN])]
-
-			# draw create a new ROI and draw to the mask image image
-			proi = PolygonRoi(roiXs, roiYs, len(roiXs), Roi.POLYGON) 
-		
-			proi.setPosition(sliceN+1)
-		
-			bsip = stack2.getProcessor(sliceN+1)
-		
-			bsip.setColor(gaussian)
-		
-			bsip.fill(proi)
-
-		BS = ImagePlus("Binary Stack", stack2)
-
-
-
-
-	#reslice the mask image, so that it can be applied to the original image 
-	
-	binaryMask=Slicer().reslice(BS)
-	stack2 = binaryMask.getImageStack()
-	stack3= ImageStack(imp1.width, imp1.height)
-	#if wanted, apply a blur to the mask, to prevent woodgrain aliasing errors
-
-	for i in xrange(imp1.getNSlices()):
-		channelI = stack2.getProcessor(i+1)
-		for j in xrange((imp1.getNChannels())):
-			stack3.addSlice(None, channelI)	
+		#the peel is thresholded from the distance transform of the mask resliced back to XY planes, which is applied to the original image as it is
+		BS = distancePeel(Slicer().reslice(BS2), gaussian, depthOffset, stackThickness, imp1.getCalibration())
+		BS2.close()
+		binaryMask = BS
+	elif keep3D:
+		#the linear offset band is rasterized straight into XY planes, so no reslice is needed
+		BS = heightMask(epidermisHeightsFull, width, len(heights), height, depthOffset, stackThickness, gaussian)
+		binaryMask = BS
+	if erode or keep3D:
+		stack2 = binaryMask.getImageStack()
+		stack3= ImageStack(imp1.width, imp1.height)
+		#if wanted, apply a blur to the mask, to prevent woodgrain aliasing errors
+
+		for i in xrange(imp1.getNSlices()):
+			channelI = stack2.getProcessor(i+1)
+			for j in xrange((imp1.getNChannels())):
+				stack3.addSlice(None, channelI)	
 			
 	heightmapFinal=[]
 	
@@ -938,20 +1967,29 @@ def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, cancele
 	fp3= FloatProcessor(width, len(heightMapArray)/width, heightMapArray, None)
 	heightsImp2= ImagePlus("Calibrated heightmap", fp3)
 	heightsImp2.setCalibration(cal)
-	heightsImp2.show()
+	if not headless:
+		heightsImp2.show()
 	areaImp = areamap( heightsImp2, cal.pixelWidth, cal.pixelHeight)
 	areaImp.setTitle("area map")
 	areaImp.setCalibration(cal)
 	areaStat =areaImp.getStatistics()
 	#IJ.setMinAndMax(areaImp, areaStat.min, areaStat.max)
 	
-	areaImp.show()
+	if not headless:
+		areaImp.show()
 	try:
 		IJ.run(areaImp, "16_colors", "")
 	except: print "bugger"
-	imp6 = ImagePlus("Binary mask to channels", stack3)
 	imp5 = extractFrame(imp1, frame)
 	imp5.setCalibration(cal)
+	if not (erode or keep3D):
+		#only the projection is wanted, so sum the band straight from the frame
+		sumProjImp = surfaceProjection(imp5, epidermisHeightsFull, depthOffset, stackThickness, gaussian)
+		imp5.close()
+		if not headless:
+			sumProjImp.show()
+		return widths, heights, epidermisHeightsFull, None, heightsImp2, None, None, areaImp, sumProjImp
+	imp6 = ImagePlus("Binary mask to channels", stack3)
 	imp6.setCalibration(cal)
 	if gaussian == 10.0:
 		IJ.run(imp6, "Gaussian Blur...", "sigma=1 stack")
@@ -967,238 +2005,879 @@ def thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, cancele
 	IJ.setMinAndMax(BS, 0, 1)
 	IJ.setMinAndMax(binaryMask, 0, 1)
 	imp4.setTitle("Segmented surface")
-	imp4.show()
+	if not headless:
+		imp4.show()
 	imp5.close()
 	
 	sumProjImp = ZProjector.run(imp4, "sum")
-	sumProjImp.show()
+	if not headless:
+		sumProjImp.show()
 	return widths, heights, epidermisHeightsFull, stack3, heightsImp2, imp4, imp6, areaImp, sumProjImp
 
-"""********************************actual script*****************************************"""
-
-
-
-#get the current image
-imp1= IJ.getImage()
-#ImageConverter(imp1).convertToGray16() 
-finish =0
+def freshFolder(parent, name):
+	"""creates a new folder in parent, numbering its name if that is taken, so files of earlier runs are never mixed into the results"""
+	path = os.path.join(parent, name)
+	n = 2
+	while os.path.exists(path):
+		path = os.path.join(parent, "%s %d" % (name, n))
+		n += 1
+	os.makedirs(path)
+	return path
+
+def streamPath(folder, name, frame):
+	return os.path.join(folder, name, "%s_t%05d.tif" % (name, frame))
+
+def streamFrame(folder, name, frame, imp):
+	"""writes one frame of a time series result to folder/name as a single TIFF holding all its planes"""
+	outputDir = os.path.join(folder, name)
+	if not os.path.isdir(outputDir):
+		os.makedirs(outputDir)
+	if imp.getStackSize() > 1:
+		FileSaver(imp).saveAsTiffStack(streamPath(folder, name, frame))
+	else:
+		FileSaver(imp).saveAsTiff(streamPath(folder, name, frame))
+
+class StreamedStack(VirtualStack):
+	"""the frames written by streamFrame as one virtual stack, reading each plane from the TIFF of its frame when it is needed"""
+	def __init__(self, paths, planesPerFrame, width, height):
+		VirtualStack.__init__(self, width, height, None, os.path.dirname(paths[0]))
+		self.paths = paths
+		self.planesPerFrame = planesPerFrame
+
+	def getSize(self):
+		return len(self.paths)*self.planesPerFrame
+
+	def getSliceLabel(self, n):
+		return None
+
+	def getProcessor(self, n):
+		frame, plane = divmod(n-1, self.planesPerFrame)
+		return Opener().openImage(self.paths[frame], plane+1).getProcessor()
+
+def openStreamed(folder, name, nChannels, nSlices, nFrames):
+	"""opens the frames streamFrame wrote for this run as a virtual stack, so planes are only read from disk when viewed"""
+	paths = [streamPath(folder, name, frame) for frame in xrange(1, nFrames+1)]
+	first = Opener().openImage(paths[0], 1)
+	imp = ImagePlus(name, StreamedStack(paths, nChannels*nSlices, first.getWidth(), first.getHeight()))
+	imp.setCalibration(first.getCalibration())
+	imp.setDimensions(nChannels, nSlices, nFrames)
+	if nChannels > 1:
+		imp = CompositeImage(imp, CompositeImage.COMPOSITE)
+	return imp
+
+def segmentFrame(imp1, frame, filtered, params):
+	"""runs secondStage and thirdStage on a frame that has been through firstStage, returning the calibrated heightmap, areamap, segmented stack and sum projection.
+	frame indexes imp1, params["label"] is the frame number reported, if imp1 holds only that frame"""
+	imp2, imp3, width, height, stats, stack, defaultThreshold, surfaceBuffer = filtered
+	surfaceSeed = params.get("seed")
+	seed = None
+	corrected = None
+	if surfaceSeed is not None:
+		seed = surfaceSeed.seedFor(params["runIndex"])
+	try:
+		heights, widths, epidermisHeightsFull, xvertices, heightMapArray, fp, heightsImp, blurredHeights, imgBlur, imgHeights, sub, subIP, subPixels, impSub = secondStage(params["minThreshold"], params["interpolation"], 0, params["interpolRes"], params["topSlice"], params["useOtsu"], defaultThreshold, imp3, surfaceBuffer, width, height, params.get("label", frame), params.get("pyramid", pyramidFactor), seed)
+		if surfaceBuffer is not None:
+			gpuLock.lock()
+			try:
+				bufferPool.release(surfaceBuffer)
+			finally:
+				gpuLock.unlock()
+		widths, heights, epidermisHeightsFull, stack3, heightsImp2, imp4, imp6, areaImp, sumProjImp = thirdStage(epidermisHeightsFull, params["erode"], params["depthOffset"], params["stackThickness"], 0, params["hdRemoval"], params["heightDiffMax"], params["gaussian"], fp, subPixels, width, height, imp1, frame, params["holeFill"], params.get("keep3D", 1))
+		#the next frame is seeded from the heightmap after hole removal
+		corrected = FloatProcessor(width, len(epidermisHeightsFull)/width, array("f", epidermisHeightsFull))
+	finally:
+		#the next frame waits for this one, so it is told even when this frame failed
+		if surfaceSeed is not None:
+			surfaceSeed.publish(params["runIndex"], corrected)
+
+	imp2.close()
+	if imp3 is not None:
+		imp3.close()
+	heightsImp.close()
+	impSub.close()
+	if imp4 is not None:
+		imp6.close()
+		imp4.setDimensions(imp1.getNChannels(), imp1.getNSlices(), 1)
+	return heightsImp2, areaImp, imp4, sumProjImp
+
+class SurfaceSeed:
+	"""the uncalibrated heightmaps of the frames of a run as they are segmented in parallel, so that every frame is seeded
+	from the frame before it in the run, whichever thread finishes first"""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.heightmaps = {}
+
+	def publish(self, runIndex, fp):
+		with self.condition:
+			if fp is not None:
+				fp = fp.duplicate()
+			self.heightmaps[runIndex] = fp
+			self.condition.notifyAll()
+
+	def seedFor(self, runIndex):
+		"""waits for the heightmap of the frame before, None for the first frame or if that frame failed"""
+		if runIndex == 0:
+			return None
+		with self.condition:
+			while runIndex-1 not in self.heightmaps:
+				self.condition.wait()
+			return self.heightmaps.pop(runIndex-1)
+
+class FramePrefetcher:
+	"""reads every plane of upcoming frames of a virtual stack on a background thread, so disk reads overlap the processing of earlier frames.
+	Each frame comes back as a single frame hyperstack held in memory"""
+	def __init__(self, imp):
+		self.imp = imp
+		self.executor = Executors.newSingleThreadExecutor()
+		self.pending = {}
+	def request(self, frame):
+		if frame not in self.pending and 1 <= frame <= self.imp.getNFrames():
+			self.pending[frame] = self.executor.submit(SliceTask(self.load, frame))
+	def load(self, frame):
+		stack = self.imp.getImageStack()
+		planes = ImageStack(self.imp.width, self.imp.height)
+		for i in range(1, self.imp.getNSlices() + 1):
+			for nChannel in range(1, self.imp.getNChannels()+1):
+				planes.addSlice(str(i), stack.getProcessor(self.imp.getStackIndex(nChannel, i, frame)))
+		frameImp = ImagePlus(self.imp.getTitle(), planes)
+		frameImp.setDimensions(self.imp.getNChannels(), self.imp.getNSlices(), 1)
+		frameImp.setCalibration(self.imp.getCalibration())
+		return frameImp
+	def get(self, frame):
+		self.request(frame)
+		return self.pending.pop(frame).get()
+	def shutdown(self):
+		self.executor.shutdownNow()
+
+def seriesCount(path):
+	"""the number of series, such as the positions of a multi-position acquisition, in an image file. 1 without Bio-Formats or if it cannot read the file"""
+	if not bioformatsInstalled:
+		return 1
+	reader = ImageReader()
+	try:
+		try:
+			reader.setId(path)
+			return reader.getSeriesCount()
+		except (Exception, JavaException):
+			return 1
+	finally:
+		reader.close()
+
+def openImage(path, virtual, series=None):
+	"""opens an image, or one series of it through Bio-Formats. With virtual set it is opened as a virtual stack through Bio-Formats
+	so planes are only read when used"""
+	if (not virtual and series is None) or not bioformatsInstalled:
+		return IJ.openImage(path)
+	#the package name is a python keyword, so the options class is loaded by name
+	options = IJ.getClassLoader().loadClass("loci.plugins.in.ImporterOptions").newInstance()
+	options.setId(path)
+	options.setVirtual(virtual)
+	options.setOpenAllSeries(False)
+	if series is not None:
+		options.clearSeries()
+		options.setSeriesOn(series, True)
+	return BF.openImagePlus(options)[0]
+
+class Profiler:
+	"""records wall time, used java heap and the bytes held by the GPU buffer pool at the entry and exit of wrapped calls, by image, frame and thread"""
+	def __init__(self):
+		self.records = []
+		self.local = threading.local()
+		self.image = ""
+
+	def setFrame(self, frame):
+		self.local.frame = frame
+
+	def sample(self):
+		runtime = Runtime.getRuntime()
+		return System.nanoTime(), runtime.totalMemory()-runtime.freeMemory(), bufferPool.bytesResident
+
+	def wrap(self, name, function):
+		"""returns function with every call recorded under name"""
+		def recorded(*args, **kwargs):
+			start = self.sample()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				end = self.sample()
+				self.records.append(OrderedDict([("image", self.image), ("frame", getattr(self.local, "frame", 0)), ("stage", name),
+					("thread", Thread.currentThread().getName()), ("seconds", (end[0]-start[0])/1e9),
+					("heapStart", start[1]), ("heapEnd", end[1]), ("pooledStart", start[2]), ("pooledEnd", end[2])]))
+		return recorded
+
+	def summary(self, records):
+		"""calls, total seconds and peak heap and pooled GPU bytes of each stage"""
+		stages = OrderedDict()
+		for record in records:
+			stage = stages.setdefault(record["stage"], OrderedDict([("calls", 0), ("seconds", 0.0), ("peakHeap", 0), ("peakPooled", 0)]))
+			stage["calls"] += 1
+			stage["seconds"] += record["seconds"]
+			stage["peakHeap"] = max(stage["peakHeap"], record["heapStart"], record["heapEnd"])
+			stage["peakPooled"] = max(stage["peakPooled"], record["pooledStart"], record["pooledEnd"])
+		return stages
+
+	def frameReport(self, frame):
+		lines = ["Frame %d:" % frame]
+		for name, stage in self.summary([r for r in self.records if r["frame"] == frame and r["image"] == self.image]).items():
+			lines.append("  %-40s %4d calls %9.3f s  heap %6d MB  GPU pool %6d MB" % (name, stage["calls"], stage["seconds"], stage["peakHeap"]/1048576, stage["peakPooled"]/1048576))
+		return "\n".join(lines)
+
+	def export(self, path):
+		"""writes every record as CSV if path ends in .csv, otherwise a JSON run summary, per frame summaries and the records"""
+		output = open(path, "w")
+		try:
+			if path.lower().endswith(".csv"):
+				if self.records:
+					output.write(",".join(self.records[0].keys()) + "\n")
+				for record in self.records:
+					output.write(",".join(['"%s"' % value if isinstance(value, basestring) else str(value) for value in record.values()]) + "\n")
+			else:
+				frames = OrderedDict()
+				for image, frame in sorted(set([(r["image"], r["frame"]) for r in self.records])):
+					frames["%s frame %d" % (image, frame)] = self.summary([r for r in self.records if r["image"] == image and r["frame"] == frame])
+				json.dump(OrderedDict([("summary", self.summary(self.records)), ("frames", frames), ("records", self.records)]), output, indent=1)
+		finally:
+			output.close()
+
+class ProfiledCalls:
+	"""stands in for the CLIJ2 backend, recording every method called on it"""
+	def __init__(self, backend, prefix):
+		self.backend = backend
+		self.prefix = prefix
+	def __getattr__(self, name):
+		attribute = getattr(self.backend, name)
+		if callable(attribute):
+			return profiler.wrap(self.prefix + name, attribute)
+		return attribute
+
+def inFrame(frame, function, *args):
+	"""calls function on a worker thread, attributing what it records to frame"""
+	if profiler is not None:
+		profiler.setFrame(frame)
+	return function(*args)
+
+def startProfiling():
+	"""wraps the stages and the CLIJ2 backend in a profiler, so nothing is recorded, or paid for, unless it is switched on"""
+	global profiler, clij2
+	profiler = Profiler()
+	clij2 = ProfiledCalls(clij2, "clij2.")
+	names = ["firstStage", "extractChannel", "smoothFilter", "tiledFilterReslice", "reslicedView", "deviceReslice", "deviceEdge", "findEdge", "deviceStatistics", "deviceHeightmap",
+		"secondStage", "thirdStage", "removeHoles", "distancePeel", "heightMask", "areamap", "surfaceProjection", "extractFrame", "segmentFrame"]
+	for name in names:
+		globals()[name] = profiler.wrap(name, globals()[name])
+
+def processFrames(imp, frames, params, collect):
+	"""segments frames with fixed settings, filtering the next frames on the GPU while earlier ones are segmented on CPU threads.
+	collect(frame, heightmap, areamap, segmented stack, sum projection) is called on this thread in frame order"""
+	global imp1, andOp
+	imp1 = imp
+	andOp = params["andOp"]
+	if params.get("temporal", temporalSearch):
+		params = dict(params, seed=SurfaceSeed())
+	#the temporal and pyramid searches run on the CPU, so they keep the surface search off the GPU
+	if "seed" in params or params.get("pyramid", pyramidFactor) > 1:
+		params = dict(params, deviceSurface=False)
+
+	#frames of virtual stacks are read into memory one at a time, ahead of when they are needed
+	prefetcher = None
+	if imp.getStack().isVirtual():
+		prefetcher = FramePrefetcher(imp)
+	frames = list(frames)
+
+	if profiler is not None:
+		profiler.image = imp.getTitle()
+
+	pool = Executors.newFixedThreadPool(framesInFlight)
+	pending = []
+	window = framesInFlight
+	try:
+		for n, frame in enumerate(frames):
+			#once the window is full, wait for the oldest frame, so at most window frames are held in memory
+			while len(pending) >= window and pending:
+				doneFrame, future = pending.pop(0)
+				collect(doneFrame, *future.get())
+				if profiler is not None:
+					print profiler.frameReport(doneFrame)
+			print "Frame:  " + str(frame)
+			if profiler is not None:
+				profiler.setFrame(frame)
+			if prefetcher is None:
+				source, sourceFrame = imp, frame
+			else:
+				source, sourceFrame = prefetcher.get(frame), 1
+				for ahead in frames[n+1:n+1+framesPrefetched]:
+					prefetcher.request(ahead)
+			imp1 = source
+			gpuLock.lock()
+			try:
+				filtered = firstStage(params["channel"], sourceFrame, params["filtertype"], params["smoothsize"], 0, params["sobeltype"], andOp, None, params["deviceSurface"])
+			finally:
+				gpuLock.unlock()
+			#frames whose surface is searched on the GPU keep their filtered stack there until they are segmented, so the window
+			#is cut to the stacks that fit next to the three buffers the next frame is filtered in
+			surfaceBuffer = filtered[-1]
+			if surfaceBuffer is not None:
+				window = min(framesInFlight, max(0, int(deviceBudget()/surfaceBuffer.getSizeInBytes()) - 3))
+			frameParams = dict(params, label=frame)
+			if "seed" in params:
+				frameParams["runIndex"] = n
+			pending.append((frame, pool.submit(SliceTask(lambda nFrame, filtered=filtered, source=source, frame=frame, frameParams=frameParams: inFrame(frame, segmentFrame, source, nFrame, filtered, frameParams), sourceFrame))))
+		for doneFrame, future in pending:
+			collect(doneFrame, *future.get())
+			if profiler is not None:
+				print profiler.frameReport(doneFrame)
+	finally:
+		pool.shutdown()
+		if prefetcher is not None:
+			prefetcher.shutdown()
+		imp1 = imp
+	print "GPU buffer pool: " + str(bufferPool.stats())
+	if profiler is not None:
+		profiler.export(profileOutput)
+		print "Profile written to " + profileOutput
+
+def batchParameters(options):
+	"""reads the segmentation settings from macro options (key=value), using the dialog defaults for anything not given"""
+	def value(key, default):
+		return Macro.getValue(options, key, str(default))
+	def flag(key, default):
+		return value(key, default).lower() in ["true", "1", "yes"]
+
+	params = {}
+	params["channel"] = int(value("channel", -1))
+	if flag("process_8bit", True):
+		params["andOp"] = 0xFF
+	else:
+		params["andOp"] = 0xffff
+	params["filtertype"] = value("smoothing", "2D Gaussian")
+	params["smoothsize"] = int(value("sigma", 4))
+	params["sobeltype"] = value("edge", "none")
+	params["deviceSurface"] = flag("gpu_surface", True)
+	params["useOtsu"] = flag("otsu", True)
+	params["minThreshold"] = float(value("threshold", 0))
+	params["interpolation"] = flag("interpolation", False)
+	params["interpolRes"] = float(value("interval", 8))
+	params["topSlice"] = int(value("ignore", 0))
+	params["erode"] = flag("erode", False)
+	params["depthOffset"] = float(value("offset", 4))
+	params["stackThickness"] = float(value("thickness", 8))
+	if flag("gaussian", True):
+		params["gaussian"] = 10.0
+	else:
+		params["gaussian"] = 1
+	params["hdRemoval"] = flag("hole_removal", True)
+	params["heightDiffMax"] = float(value("divergence", 15))
+	params["holeFill"] = value("hole_fill", "inpaint")
+	params["keep3D"] = flag("keep_3d", True)
+	params["pyramid"] = int(value("pyramid", pyramidFactor))
+	params["temporal"] = flag("temporal", temporalSearch)
+	return params
+
+def batchInputs(source):
+	"""lists the images to process from a folder, or from a text file with one path per line"""
+	if os.path.isdir(source):
+		return [os.path.join(source, name) for name in sorted(os.listdir(source)) if os.path.splitext(name)[1].lower() in [".tif", ".tiff", ".lsm", ".czi", ".lif", ".nd2", ".ims", ".oib", ".oif"]]
+	listFile = open(source)
+	paths = [line.strip() for line in listFile if line.strip()]
+	listFile.close()
+	return paths
+
+def runBatch(params, paths, outputDir, virtual=False):
+	"""segments every frame of every image without dialogs or windows, writing the outputs to outputDir.
+	An image that cannot be opened or segmented is logged and skipped, and the failures are listed at the end"""
+	global headless
+	headless = 1
+	if not os.path.isdir(outputDir):
+		os.makedirs(outputDir)
+
+	done = []
+	failed = []
+	try:
+		for path in paths:
+			#every series of a multi-series file, such as each position of a multi-position acquisition, is segmented as an image of its own
+			nSeries = seriesCount(path)
+			for series in xrange(nSeries):
+				name = os.path.splitext(os.path.basename(path))[0]
+				label = path
+				if nSeries > 1:
+					name += "_s" + str(series+1)
+					label += " series " + str(series+1)
+				imp = None
+				try:
+					if nSeries > 1:
+						imp = openImage(path, virtual, series)
+					else:
+						imp = openImage(path, virtual)
+					if imp is None:
+						raise IOError("could not open the image")
+					if imp.getBitDepth() == 24:
+						raise ValueError("RGB images must be converted before processing")
+					print "Processing " + label
+					processFile(imp, name, params, outputDir)
+					done.append(label)
+				except (Exception, JavaException), e:
+					print "Skipping %s: %s" % (label, str(e))
+					failed.append(label)
+				finally:
+					if imp is not None:
+						imp.close()
+	finally:
+		headless = 0
+	print "Batch finished, %d of %d images segmented" % (len(done), len(done)+len(failed))
+	for label in failed:
+		print "  failed: " + label
+
+def processFile(imp, name, params, outputDir):
+	"""segments every frame of an opened batch image, saving the outputs under name"""
+	fileParams = dict(params)
+	#like the dialog, default to the last channel
+	if fileParams["channel"] < 0:
+		fileParams["channel"] = imp.getNChannels()-1
+
+	def save(nFrame, heightsImp2, areaImp, imp4, sumProjImp):
+		if imp.getNFrames() > 1:
+			prefix = os.path.join(outputDir, name + "_t" + str(nFrame))
+		else:
+			prefix = os.path.join(outputDir, name)
+		for output, suffix in [(heightsImp2, "_heightmap.tif"), (areaImp, "_areamap.tif"), (imp4, "_segmented.tif"), (sumProjImp, "_projection.tif")]:
+			if output is not None:
+				FileSaver(output).saveAsTiff(prefix + suffix)
+				output.close()
+	processFrames(imp, xrange(1, imp.getNFrames()+1), fileParams, save)
+
+def syntheticStack(width, height, depth, bitDepth, nChannels, seed):
+	"""makes a single frame stack with a bright curved surface two slices thick, background noise and holes where the surface is missing.
+	Returns the stack and its true heightmap as a floatProcessor"""
+	#a dome with ripples, so the surface crosses many slices
+	trueHeights = FloatProcessor(width, height)
+	for y in xrange(height):
+		for x in xrange(width):
+			dome = math.cos(math.pi*(x-width/2.0)/width)*math.cos(math.pi*(y-height/2.0)/height)
+			ripple = math.sin(x*12.0/width)*math.sin(y*9.0/height)
+			trueHeights.setf(x, y, depth*(0.55 - 0.35*dome + 0.05*ripple))
+	trueHeights = FloatProcessor(width, height, array("f", [float(int(h)) for h in trueHeights.getPixels()]))
+
+	#holes drop the surface signal in a few discs
+	present = ByteProcessor(width, height)
+	present.setValue(255)
+	present.fill()
+	present.setValue(0)
+	radius = max(2, width/40)
+	for i in xrange(8):
+		present.fillOval(int((0.1+0.1*i)*width), int((0.15+0.09*((i*5) % 8))*height), 2*radius, 2*radius)
+
+	signal = {8: 180.0, 16: 3000.0}[bitDepth]
+	background = signal/20
+	top = bandTop(trueHeights.getPixels(), width, height, 0)
+	ImageProcessor.setRandomSeed(seed)
+	stack = ImageStack(width, height)
+	for z in xrange(1, depth+1):
+		wall = bandPlane(top, z, 2, 255)
+		wall.copyBits(present, 0, 0, Blitter.AND)
+		for nChannel in xrange(1, nChannels+1):
+			plane = wall.convertToFloat()
+			plane.multiply(signal/255.0/nChannel)
+			plane.add(background)
+			plane.noise(background/2)
+			plane.setMinAndMax(0, {8: 255, 16: 65535}[bitDepth])
+			if bitDepth == 8:
+				plane = plane.convertToByte(False)
+			else:
+				plane = plane.convertToShort(False)
+			stack.addSlice(None, plane)
+	imp = ImagePlus("Synthetic surface", stack)
+	imp.setDimensions(nChannels, depth, 1)
+	return imp, trueHeights
+
+def timeStages(imp, trueHeights, nChannel, andOp):
+	"""runs each stage once on a synthetic stack, returning the seconds spent in each and the mean heightmap error in slices"""
+	times = OrderedDict()
+	def timed(stage, function, *args):
+		start = System.nanoTime()
+		result = function(*args)
+		times[stage] = (System.nanoTime()-start)/1e9
+		return result
+
+	imp2 = timed("extractChannel", extractChannel, imp, nChannel, 1, andOp)
+	src = timed("smoothFilter", smoothFilter, imp2, "2D Gaussian", 2)
+	imp3 = timed("reslice", reslicedView, src)
+	bufferPool.release(src)
+	imp2.close()
+
+	#threshold half way between the background and the surface signal
+	threshold = (imp3.getStatistics().max + imp3.getStatistics().min)/2
+	width, depth = imp3.getWidth(), imp3.getHeight()
+	surface = timed("secondStage", secondStage, threshold, False, 0, 8, 0, 0, threshold, imp3, None, width, depth, 1)
+	epidermisHeightsFull, fp, subPixels = surface[2], surface[5], surface[12]
+	detected = FloatProcessor(width, len(subPixels)/width, array("f", epidermisHeightsFull))
+	detected.copyBits(trueHeights, 0, 0, Blitter.DIFFERENCE)
+	error = detected.getStatistics().mean
+
+	filled = timed("holeRemoval", removeHoles, fp, subPixels, width, 1.5, "inpaint")
+	mask = timed("mask", heightMask, filled, width, len(subPixels)/width, depth, 4, 8, 10.0)
+	heightsImp = ImagePlus("Heightmap", FloatProcessor(width, len(subPixels)/width, array("f", filled)))
+	areaImp = timed("areamap", areamap, heightsImp, 1.0, 1.0)
+	frameImp = extractFrame(imp, 1)
+	projection = timed("projection", surfaceProjection, frameImp, filled, 4, 8, 10.0)
+	for output in [imp3, surface[6], surface[13], mask, heightsImp, areaImp, frameImp, projection]:
+		output.close()
+	return times, error
+
+def runBenchmark(outputPath):
+	"""times every stage on synthetic stacks of each benchmark size, bit depth and channel count, writing the results to outputPath as JSON"""
+	global headless, imp1, andOp, cachedIndex
+	headless = 1
+	results = []
+	for width, height, depth in benchmarkSizes:
+		for bitDepth in benchmarkBitDepths:
+			for nChannels in benchmarkChannels:
+				imp, trueHeights = syntheticStack(width, height, depth, bitDepth, nChannels, benchmarkSeed)
+				imp1 = imp
+				andOp = {8: 0xFF, 16: 0xffff}[bitDepth]
+				for repeat in xrange(benchmarkRepeats):
+					cachedIndex = None
+					times, error = timeStages(imp, trueHeights, 1, andOp)
+					print "Benchmark %dx%dx%d, %d-bit, %d channels: %s" % (width, height, depth, bitDepth, nChannels, str(dict(times)))
+					results.append(OrderedDict([("width", width), ("height", height), ("slices", depth), ("bitDepth", bitDepth), ("channels", nChannels),
+						("repeat", repeat), ("seconds", times), ("heightError", error)]))
+				imp.close()
+	report = OrderedDict([("backend", clij2.getGPUName()), ("threads", Prefs.getThreads()), ("imagej", IJ.getVersion()), ("seed", benchmarkSeed), ("results", results)])
+	output = open(outputPath, "w")
+	json.dump(report, output, indent=1)
+	output.close()
+	headless = 0
 
-canceled1 =0
-canceled2 =0
-canceled3 =0
-canceled4 =0
+"""********************************actual script*****************************************"""
 
-oked1 = 0
-oked2 = 0
-oked3 = 0
-oked4 = 0
-stage=1
+#pick the GPU if one can be used, otherwise run on the CPU
+clij2, clij, gpuBackend = selectBackend()
+if gpuBackend:
+	bufferPool = BufferPool(clij.getGPUMemoryInBytes()*bufferPoolFraction)
+else:
+	bufferPool = BufferPool(Runtime.getRuntime().maxMemory()*bufferPoolFraction)
+stageCache = StageCache(Runtime.getRuntime().maxMemory()*stageCacheFraction)
+
+#a check_backends=true macro option runs the backend check, as does checkBackends
+macroOptions = Macro.getOptions()
+if macroOptions is not None and Macro.getValue(macroOptions, "check_backends", "false").lower() == "true":
+	checkBackends = True
+if checkBackends:
+	if gpuBackend:
+		compareBackends()
+	else:
+		print "Backend check skipped, no GPU to compare the CPU backend with"
+
+#a profile=[file] macro option switches the profiler on and sets where it is written
+if macroOptions is not None and Macro.getValue(macroOptions, "profile", "") != "":
+	profiling = True
+	profileOutput = Macro.getValue(macroOptions, "profile", "")
+if profiling:
+	startProfiling()
+
+#a macro call with an input=[folder or list file] option runs the whole batch without dialogs
+if macroOptions is not None and Macro.getValue(macroOptions, "benchmark", "") != "":
+	runBenchmark(Macro.getValue(macroOptions, "benchmark", ""))
+	if profiler is not None:
+		profiler.export(profileOutput)
+		print "Profile written to " + profileOutput
+elif macroOptions is not None and Macro.getValue(macroOptions, "input", "") != "":
+	batchSource = Macro.getValue(macroOptions, "input", "")
+	runBatch(batchParameters(macroOptions), batchInputs(batchSource), Macro.getValue(macroOptions, "output", os.path.join(os.path.dirname(batchSource), "EZ Peeler output")), Macro.getValue(macroOptions, "virtual", "false").lower() == "true")
+else:
+	#get the current image
+	imp1= IJ.getImage()
+	if profiler is not None:
+		profiler.image = imp1.getTitle()
+	#ImageConverter(imp1).convertToGray16() 
+	finish =0
+
+	canceled1 =0
+	canceled2 =0
+	canceled3 =0
+	canceled4 =0
 
-headless = 0
-keep3D=1
-keepZP=1
-keepHM=1
-keepAM=1
-while (canceled1 == 0 and oked4==0):
+	oked1 = 0
 	oked2 = 0
 	oked3 = 0
 	oked4 = 0
-	canceled2 =0
-	canceled3 =0
-	canceled4 =0
-	while stage==1:
-		#cleanup open images
-		try:
-			imp2.close()
-		except:
-			print "imp2 already closed"
-		try:
-			imp3.close()
-		except:
-			print "imp3 already closed"
+	stage=1
+
+	#nothing is open or on the GPU before the first dialog
+	imp2 = None
+	imp3 = None
+	surfaceBuffer = None
+
+	keep3D=1
+	keepZP=1
+	keepHM=1
+	keepAM=1
+	while (canceled1 == 0 and oked4==0):
+		oked2 = 0
+		oked3 = 0
+		oked4 = 0
+		canceled2 =0
+		canceled3 =0
+		canceled4 =0
+		while stage==1:
+			#cleanup open images, cached ones are only hidden
+			try:
+				if stageCache.holds(imp2):
+					imp2.hide()
+				else:
+					imp2.close()
+			except:
+				print "imp2 already closed"
+			try:
+				if stageCache.holds(imp3):
+					imp3.hide()
+				else:
+					imp3.close()
+			except:
+				print "imp3 already closed"
+			gpuLock.lock()
+			try:
+				bufferPool.release(surfaceBuffer)
+			finally:
+				gpuLock.unlock()
+			surfaceBuffer = None
 		
-		#ask the user the settings they want
-		userOptions1 = getOptions1(imp1)
+			#ask the user the settings they want
+			userOptions1 = getOptions1(imp1)
 	
-		channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU, oked1 = userOptions1
-		if canceled1==1:
-			stage=0
-			break
-		if oked1==1:
-			stage=2
+			channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU, oked1, deviceSurface = userOptions1
+			if canceled1==1:
+				stage=0
+				break
+			if oked1==1:
+				stage=2
 		
-		frame=int(frame)
-		clij2.getInstance(GPU)
+			frame=int(frame)
+			clij2.getInstance(GPU)
+			#the pyramid search runs on the CPU, so it keeps the surface search off the GPU
+			if pyramidFactor > 1:
+				deviceSurface = False
 		
 
-		imp2, imp3, width, height, stats, stack, defaultThreshold = firstStage(channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU)
+			#filtering again is only needed when the image, channel, frame, filter settings or surface search changed
+			cacheKey = stageCache.key(imp1, channels, frame, filtertype, smoothsize, sobeltype, andOp, deviceSurface)
+			filtered = stageCache.get(cacheKey)
+			if filtered is None:
+				gpuLock.lock()
+				try:
+					filtered = firstStage(channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU, deviceSurface)
+				finally:
+					gpuLock.unlock()
+				#results left on the GPU are not cached
+				if filtered[-1] is None:
+					stageCache.put(cacheKey, filtered)
+			elif not headless:
+				filtered[1].show()
+			imp2, imp3, width, height, stats, stack, defaultThreshold, surfaceBuffer = filtered
 
 
 		
-	#run the second dialog
-	while stage==2:
-		oked3 = 0
-		oked4 = 0
-		canceled3 =0
-		canceled4 =0
-		#cleanup open images
-		try:
-			heightsImp.close()
-		except:
-			print "heightsImp already closed"
-		try:
-			impSub.close()
-		except:
-			print "impSub already closed"			
+		#run the second dialog
+		while stage==2:
+			oked3 = 0
+			oked4 = 0
+			canceled3 =0
+			canceled4 =0
+			#cleanup open images
+			try:
+				heightsImp.close()
+			except:
+				print "heightsImp already closed"
+			try:
+				impSub.close()
+			except:
+				print "impSub already closed"			
+		
+			#the resliced preview of a GPU resident stack is only built once it is looked at
+			if imp3 is None:
+				gpuLock.lock()
+				try:
+					imp3 = reslicedView(surfaceBuffer)
+				finally:
+					gpuLock.unlock()
+				displayResliced(imp3, channels, frame, stats.max)
+				stack = imp3.getStack()
 		
-		userOptions2 = getOptions2(imp3, stats.max, height-1, stack, andOp, width, defaultThreshold)	
+			userOptions2 = getOptions2(imp3, stats.max, height-1, stack, andOp, width, defaultThreshold)	
 		
 			
-		#minThreshold, interpolation, hdRemoval, heightDiffMax, canceled2,  interpolRes, topSlice = userOptions2
-		minThreshold, interpolation, canceled2,  interpolRes, topSlice, oked2 , useOtsu= userOptions2
+			#minThreshold, interpolation, hdRemoval, heightDiffMax, canceled2,  interpolRes, topSlice = userOptions2
+			minThreshold, interpolation, canceled2,  interpolRes, topSlice, oked2 , useOtsu= userOptions2
 
 		
-		if canceled2==1:
-			stage=1
-			break
-		if oked2==1:
-			stage=3
-		heights, widths, epidermisHeightsFull, xvertices, heightMapArray, fp, heightsImp, blurredHeights, imgBlur, imgHeights, sub, subIP, subPixels, impSub=secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice, useOtsu, defaultThreshold)
-
-	while stage==3:
-
-		try:
-			BS.close()
-		except:
-			print "BS already closed"
-		try:
-			BS2.close()
-		except:
-			print "BS2 already closed"
-		try:
-			imp4.close()
-		except:
-			print "imp4 already closed"
-		try:
-			imp5.close()
-		except:
-			print "imp5 already closed"
-		try:
-			imp6.close()
-		except:
-			print "imp6 already closed"
-		try:
-			areaImp.close()				
-		except:
-			print "areaImp already closed"
+			if canceled2==1:
+				stage=1
+				break
+			if oked2==1:
+				stage=3
+			heights, widths, epidermisHeightsFull, xvertices, heightMapArray, fp, heightsImp, blurredHeights, imgBlur, imgHeights, sub, subIP, subPixels, impSub=secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice, useOtsu, defaultThreshold, imp3, surfaceBuffer, width, height, frame, pyramidFactor)
+
+		while stage==3:
+
+			try:
+				BS.close()
+			except:
+				print "BS already closed"
+			try:
+				BS2.close()
+			except:
+				print "BS2 already closed"
+			try:
+				imp4.close()
+			except:
+				print "imp4 already closed"
+			try:
+				imp5.close()
+			except:
+				print "imp5 already closed"
+			try:
+				imp6.close()
+			except:
+				print "imp6 already closed"
+			try:
+				areaImp.close()				
+			except:
+				print "areaImp already closed"
 			
-		try:
-			impSub.close()				
-		except:
-			print "impSub already closed"
-		try:
-			heightsImp2.close()
-		except:
-			print "heightsImp2 already closed"
-		oked4 = 0
-		canceled4 =0
+			try:
+				impSub.close()				
+			except:
+				print "impSub already closed"
+			try:
+				heightsImp2.close()
+			except:
+				print "heightsImp2 already closed"
+			oked4 = 0
+			canceled4 =0
 		
 
 		
-		userOptions3 = getOptions3(impSub, subPixels, imp3, epidermisHeightsFull)
+			userOptions3 = getOptions3(impSub, subPixels, imp3, epidermisHeightsFull)
 
-		erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian,xzOffset, xzThickness, oked3= userOptions3
+			erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian, oked3, holeFill= userOptions3
 		
 		
-		if canceled3==1:
-			stage=2
-			break
-		if oked3==1:
-			stage=4
+			if canceled3==1:
+				stage=2
+				break
+			if oked3==1:
+				stage=4
 
-		widths, heights, epidermisHeightsFull, stack3, heightsImp2, imp4, imp6, areaImp, sumProjImp = thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian,xzOffset, xzThickness)	
+			widths, heights, epidermisHeightsFull, stack3, heightsImp2, imp4, imp6, areaImp, sumProjImp = thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian, fp, subPixels, width, height, imp1, frame, holeFill)	
 
 		
 
 		
-	#Final dialog loop
-		
-	while stage==4:
-		finalOptions=finalDialog()
-		canceled4, timeseries, oked4, keep3D, keepZP, keepHM, keepAM, keepPrev = finalOptions
-		if canceled4==1:
-			stage=3
-			break
-		if oked4==1:
-			stage=5
-
-imp2.close()
-imp3.close()
-impSub.close()
-heightsImp.close()
-
-if keepPrev == 0:
-	sumProjImp.close()
-	heightsImp2.close()
-	imp4.close()
-	areaImp.close()
-	imp6.close()
-if timeseries == 1:
-	headless = 0
-	stack4= ImageStack(imp1.width, imp1.height)
-	stack5 = ImageStack(imp1.width, imp1.height)
-	stack6 = ImageStack(imp1.width, imp1.height)
-	stack7 = ImageStack(imp1.width, imp1.height)
-
-	for frame in xrange(1, imp1.getNFrames()+1):
-		print "Frame:  " + str(frame)
-		imp2, imp3, width, height, stats, stack, defaultThreshold = firstStage(channels, frame, filtertype, smoothsize, canceled1, sobeltype, andOp, GPU)
-		heights, widths,  epidermisHeightsFull, xvertices, heightMapArray, fp, heightsImp, blurredHeights, imgBlur, imgHeights, sub, subIP, subPixels, impSub=secondStage(minThreshold, interpolation, canceled2,  interpolRes, topSlice, useOtsu, defaultThreshold)
-		widths, heights, epidermisHeightsFull, stack3, heightsImp2, imp4, imp6, areaImp, sumProjImp = thirdStage(epidermisHeightsFull, erode, depthOffset, stackThickness, canceled3, hdRemoval, heightDiffMax, gaussian,xzOffset, xzThickness)	
-		if keepAM:
-			stack7.addSlice(areaImp.getProcessor())
-		if keepHM:
-			stack6.addSlice(heightsImp2.getProcessor())
-		if keep3D:
-			imp4stack=imp4.getImageStack()
-			for i in xrange(1, imp4stack.getSize()+1):	
-				try:	
-					stack4.addSlice(imp4stack.getProcessor(i))	
-				except: print "FAIL"
-		if keepZP:
-			imp5stack = sumProjImp.getImageStack()
-			for i in xrange(1, imp5stack.getSize()+1):	
-				try:	
-					stack5.addSlice(imp5stack.getProcessor(i))	
-				except: print "FAIL"
+		#Final dialog loop
 		
-		sumProjImp.close()		
-		imp6.close()
-		areaImp.close()
+		while stage==4:
+			finalOptions=finalDialog()
+			canceled4, timeseries, oked4, keep3D, keepZP, keepHM, keepAM, keepPrev, streamToDisk = finalOptions
+			if canceled4==1:
+				stage=3
+				break
+			if oked4==1:
+				stage=5
+
+	imp2.close()
+	imp3.close()
+	impSub.close()
+	heightsImp.close()
+	gpuLock.lock()
+	try:
+		bufferPool.release(surfaceBuffer)
+	finally:
+		gpuLock.unlock()
+	stageCache.clear()
+
+	if keepPrev == 0:
+		sumProjImp.close()
 		heightsImp2.close()
 		imp4.close()
-		heightsImp.close()	
-		impSub.close()
-		imp2.close()
-		imp3.close()
+		areaImp.close()
+		imp6.close()
+	if timeseries == 1:
+		stack4= ImageStack(imp1.width, imp1.height)
+		stack5 = ImageStack(imp1.width, imp1.height)
+		stack6 = ImageStack(imp1.width, imp1.height)
+		stack7 = ImageStack(imp1.width, imp1.height)
+
+		#the settings chosen in the dialogs are applied to every frame
+		params = {"channel": channels, "andOp": andOp, "filtertype": filtertype, "smoothsize": smoothsize, "sobeltype": sobeltype, "deviceSurface": deviceSurface,
+			"minThreshold": minThreshold, "interpolation": interpolation, "interpolRes": interpolRes, "topSlice": topSlice, "useOtsu": useOtsu,
+			"erode": erode, "depthOffset": depthOffset, "stackThickness": stackThickness, "hdRemoval": hdRemoval, "heightDiffMax": heightDiffMax, "holeFill": holeFill,
+			"gaussian": gaussian, "keep3D": keep3D, "pyramid": pyramidFactor}
+
+		#long series can be written to disk frame by frame instead of being held in memory
+		streamFolder = None
+		if streamToDisk:
+			streamFolder = DirectoryChooser("Folder for the time series results").getDirectory()
+			if streamFolder:
+				streamFolder = freshFolder(streamFolder, "EZ Peeler results")
+
+		def keepFrame(frame, heightsImp2, areaImp, imp4, sumProjImp):
+			if streamFolder:
+				for keep, name, output in [(keep3D, "Segmented timeseries", imp4), (keepAM, "Areamap timeseries", areaImp), (keepHM, "Segmented timeseries heightmaps", heightsImp2), (keepZP, "Segmented timeseries sum projection", sumProjImp)]:
+					if keep:
+						streamFrame(streamFolder, name, frame, output)
+			else:
+				if keepAM:
+					stack7.addSlice(areaImp.getProcessor())
+				if keepHM:
+					stack6.addSlice(heightsImp2.getProcessor())
+				if keep3D:
+					imp4stack=imp4.getImageStack()
+					for i in xrange(1, imp4stack.getSize()+1):	
+						try:	
+							stack4.addSlice(imp4stack.getProcessor(i))	
+						except: print "FAIL"
+				if keepZP:
+					imp5stack = sumProjImp.getImageStack()
+					for i in xrange(1, imp5stack.getSize()+1):	
+						try:	
+							stack5.addSlice(imp5stack.getProcessor(i))	
+						except: print "FAIL"
 		
-	if keep3D:
-		imp7 = ImagePlus("Segmented timeseries", stack4)
-		imp7.setDimensions(imp1.getNChannels(), imp1.getNSlices(), imp1.getNFrames())
-		imp7 = CompositeImage(imp7, CompositeImage.COMPOSITE)  
-		imp7.show()
-	if keepAM:
-		imp10 = ImagePlus("Areamap timeseries", stack7)
-		imp10.setDimensions(1, 1, imp1.getNFrames())
-		imp10.show()
-	
-	if keepHM:
-		imp9 = ImagePlus("Segmented timeseries heightmaps", stack6)
-		imp9.setDimensions(1, 1, imp1.getNFrames())
-		imp9.show()
-	if keepZP:
-		imp8 = ImagePlus("Segmented timeseries sum projection", stack5)
-		imp8.setDimensions(imp1.getNChannels(), 1, imp1.getNFrames())
-		imp8 = CompositeImage(imp8, CompositeImage.COMPOSITE)  
-		imp8.show()
+			sumProjImp.close()		
+			areaImp.close()
+			heightsImp2.close()
+			if imp4 is not None:
+				imp4.close()
 
+		#frames are segmented on worker threads, so no per frame windows are opened
+		headless = 1
+		processFrames(imp1, xrange(1, imp1.getNFrames()+1), params, keepFrame)
+		headless = 0
+		
+		if streamFolder:
+			for keep, name, nChannels, nSlices in [(keep3D, "Segmented timeseries", imp1.getNChannels(), imp1.getNSlices()), (keepAM, "Areamap timeseries", 1, 1), (keepHM, "Segmented timeseries heightmaps", 1, 1), (keepZP, "Segmented timeseries sum projection", imp1.getNChannels(), 1)]:
+				if keep:
+					openStreamed(streamFolder, name, nChannels, nSlices, imp1.getNFrames()).show()
+		else:
+			if keep3D:
+				imp7 = ImagePlus("Segmented timeseries", stack4)
+				imp7.setDimensions(imp1.getNChannels(), imp1.getNSlices(), imp1.getNFrames())
+				imp7 = CompositeImage(imp7, CompositeImage.COMPOSITE)  
+				imp7.show()
+			if keepAM:
+				imp10 = ImagePlus("Areamap timeseries", stack7)
+				imp10.setDimensions(1, 1, imp1.getNFrames())
+				imp10.show()
+		
+			if keepHM:
+				imp9 = ImagePlus("Segmented timeseries heightmaps", stack6)
+				imp9.setDimensions(1, 1, imp1.getNFrames())
+				imp9.show()
+			if keepZP:
+				imp8 = ImagePlus("Segmented timeseries sum projection", stack5)
+				imp8.setDimensions(imp1.getNChannels(), 1, imp1.getNFrames())
+				imp8 = CompositeImage(imp8, CompositeImage.COMPOSITE)  
+				imp8.show()
+	elif profiler is not None:
+		#a single frame is not run through processFrames, so its profile is written here
+		profiler.export(profileOutput)
+		print "Profile written to " + profileOutput